@@ -11,27 +11,56 @@
 ################################################################################
 
 
-import filecmp
+import hashlib
 import logging
 import os
-import shlex
-import subprocess
 import tempfile
-from pathlib import Path
+import threading
+from copy import deepcopy
+from typing import List, Optional, Tuple
 from urllib.parse import urlparse
 
+import mutagen
+import requests
 import yt_dlp as youtube_dl
+from cachetools import TTLCache
+from mutagen.aiff import AIFF
+from mutagen.flac import FLAC
+from mutagen.mp3 import MP3, BitrateMode
+from mutagen.mp4 import MP4
+from mutagen.wave import WAVE
 from slugify import slugify
+from yt_dlp.extractor.youtube import YoutubeIE
 
+from httpclient import session
+from library import Library, normalize_url
+from metrics import registry
 from parseconf import config
+from probe import ProbeError, probe
 
 config = config["download"]
 AUDIO_EXTENSIONS = config["AUDIO_EXTENSIONS"]
 MAX_AUDIO_LENGTH = config["MAX_AUDIO_LENGTH"]
 MAX_FILE_SIZE = config["MAX_FILE_SIZE"]
 YT_VALID_VIDEO_DOMAINS = config["YT_VALID_VIDEO_DOMAINS"]
+LIBRARY_DB = config.get("LIBRARY_DB", "~/.mpdbot/library.sqlite")
+HTTP_TIMEOUT = 30
+DOWNLOAD_CHUNK_SIZE = 64 * 1024
+# Bytes downloaded before trying to read the duration from the header
+PROBE_HEAD_SIZE = 256 * 1024
+META_CACHE_SIZE = 256
+# Stream urls in youtube's info dicts expire after a few hours
+META_CACHE_TTL = 1800
 
 logger = logging.getLogger()
+library = Library(LIBRARY_DB)
+_meta_cache = TTLCache(META_CACHE_SIZE, META_CACHE_TTL)
+_meta_lock = threading.Lock()
+download_seconds = registry.histogram(
+    "mpdbot_download_seconds", "Time to get a requested audio into the library, by source")
+download_errors = registry.counter(
+    "mpdbot_download_errors_total", "Failed downloads by source and error")
+download_bytes = registry.counter("mpdbot_download_bytes_total", "Bytes streamed by http downloads")
 
 
 class MaxFilesize(Exception):
@@ -62,9 +91,19 @@ def allowed_file(filename):
            filename.split('.')[-1].lower() in AUDIO_EXTENSIONS
 
 
+def source_keys(url: str) -> List[str]:
+    """Library keys identifying what a url points to, computed without
+    touching the network."""
+    keys = []
+    match = YoutubeIE._match_valid_url(url.strip())
+    if match and match.group("id"):
+        keys.append(f"youtube:{match.group('id')}")
+    keys.append(f"url:{normalize_url(url)}")
+    return keys
+
+
 def get_audio_length(audio_path):
-    audio_path = shlex.quote(audio_path)
-    return float(subprocess.check_output(f"ffprobe -i {audio_path} -show_entries format=duration -v quiet -of csv=\"p=0\"", shell=True).decode().strip())
+    return probe(audio_path).duration
 
 
 def yt_chapters(uri):
@@ -83,26 +122,78 @@ def yt_chapters(uri):
             title = result["title"]
 
 
-def move_file(from_path: str, raw_filename: str, out_dir: str, suffix: str):
-    return_path = os.path.expanduser(os.path.join(
-        out_dir, slugify(raw_filename) + suffix))
-    if Path(return_path).is_dir():
-        logger.info(
-            "User attempted to overwrite directory: {}".format(return_path))
-        raise FailedToProcess
-    if Path(return_path).is_file():
-        if filecmp.cmp(from_path, return_path):
+def hash_file(path: str) -> str:
+    """sha256 hex digest of a file, read in chunks."""
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(DOWNLOAD_CHUNK_SIZE), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def _indexed_hash(path: str) -> Optional[str]:
+    """Hash of a file already in out_dir, hashing and recording it once if it
+    predates the index."""
+    digest = library.file_hash(path)
+    if digest is None and os.path.isfile(path):
+        digest = hash_file(path)
+        library.add_file(path, digest, os.path.getsize(path))
+    return digest
+
+
+def move_file(from_path: str, raw_filename: str, out_dir: str, suffix: str,
+              digest: Optional[str] = None):
+    """Move a downloaded file into the library.
+
+    If an identical file is already stored it is reused and from_path is
+    removed. Name collisions with different content are resolved by
+    appending part of the content hash to the name. digest is the sha256 of
+    from_path when the caller computed it while writing the file.
+    """
+    digest = digest or hash_file(from_path)
+    existing = library.find_hash(digest)
+    if existing:
+        os.remove(from_path)
+        logger.info(f"Reusing identical file {existing=}")
+        return existing
+
+    out_dir = os.path.expanduser(out_dir)
+    stem = slugify(raw_filename)
+    for name in (stem + suffix, f"{stem}_{digest[:12]}{suffix}"):
+        return_path = os.path.join(out_dir, name)
+        if not os.path.lexists(return_path):
+            break
+        if _indexed_hash(return_path) == digest:
             os.remove(from_path)
             return return_path
-        return move_file(from_path, raw_filename, out_dir, "_" + suffix)
-    out_dir = os.path.expanduser(out_dir)
+    else:
+        logger.info(f"Could not find a free name for {raw_filename=} in {out_dir}")
+        os.remove(from_path)
+        raise FailedToProcess
+
     os.makedirs(out_dir, exist_ok=True)
     logger.debug(f"{out_dir=}")
     os.rename(from_path, return_path)
+    library.add_file(return_path, digest, os.path.getsize(return_path))
     logger.info(f"Downloaded file to {return_path=}")
     return return_path
 
 
+def yt_probe(ydl: youtube_dl.YoutubeDL, link: str) -> dict:
+    """Info dict of a video, extracted at most once per META_CACHE_TTL and
+    shared by all the download workers."""
+    key = source_keys(link)[0]
+    with _meta_lock:
+        meta = _meta_cache.get(key)
+    if meta is None:
+        meta = ydl.extract_info(link, download=False)
+        with _meta_lock:
+            _meta_cache[key] = meta
+    else:
+        logger.debug(f"Metadata cache hit for {key=}")
+    return meta
+
+
 def yt_download_audio(link: str, out_dir: str):
     with tempfile.TemporaryDirectory() as tmpdir:
         ydl_opts = {
@@ -117,46 +208,131 @@ def yt_download_audio(link: str, out_dir: str):
             'keepvideo': 'False'
         }
         _id = link.strip()
+        with youtube_dl.YoutubeDL(ydl_opts) as ydl:
+            try:
+                meta = yt_probe(ydl, _id)
+            except Exception:
+                raise FailedToDownload
+            if meta.get("duration", MAX_AUDIO_LENGTH) > MAX_AUDIO_LENGTH:
+                raise MaxAudioLength
+            try:
+                # Download from the probed info instead of extracting it again
+                meta = ydl.process_ie_result(deepcopy(meta), download=True)
+            except Exception:
+                raise FailedToDownload
+        save_location = meta['id'] + ".mp3"
+        return_path = move_file(tmpdir + "/" + save_location, meta['title'], out_dir, ".mp3")
+        library.remember(
+            [f"{meta['extractor_key'].lower()}:{meta['id']}"], return_path)
+        return return_path
+
+
+def estimate_audio_length(head_path: str, total_size: Optional[int]) -> Optional[float]:
+    """Guess the duration of a whole audio file from the first bytes of it
+    when its container header allows, None otherwise."""
+    try:
+        audio = mutagen.File(head_path)
+    except Exception:
+        return None
+    if audio is None:
+        return None
+    if isinstance(audio, MP3):
+        # Without a vbr header mutagen derives the length from the size of
+        # the partial file, the full size gives the real one
+        if audio.info.bitrate_mode != BitrateMode.VBR and total_size and audio.info.bitrate:
+            # The ID3v2 tag, cover art included, isn't audio
+            tag_size = audio.tags.size if audio.tags is not None else 0
+            return max(total_size - tag_size, 0) * 8 / audio.info.bitrate
+        return audio.info.length
+    if isinstance(audio, (FLAC, WAVE, AIFF, MP4)):
+        return audio.info.length
+    return None
+
+
+def http_download_audio(url: str, suffix: str) -> Tuple[str, str]:
+    """Stream url into a temporary file, returning its path and sha256.
+
+    Gives up as soon as the file is known to be over MAX_FILE_SIZE, from
+    Content-Length or while streaming, or its header shows it is longer
+    than MAX_AUDIO_LENGTH.
+    """
+    try:
+        response = session().get(url, stream=True, timeout=HTTP_TIMEOUT)
+        response.raise_for_status()
+    except requests.RequestException:
+        raise FailedToDownload
+    with response:
+        total_size = response.headers.get("Content-Length")
+        total_size = int(total_size) if total_size and total_size.isdigit() else None
+        if total_size and total_size > MAX_FILE_SIZE:
+            raise MaxFilesize
+        audio_file = tempfile.NamedTemporaryFile(delete=False, suffix=suffix)
         try:
-            meta = youtube_dl.YoutubeDL(
-                {**ydl_opts, "simulate": True}).extract_info(_id)
-        except Exception:
-            raise FailedToDownload
-        if meta.get("duration", MAX_AUDIO_LENGTH) > MAX_AUDIO_LENGTH:
-            raise MaxAudioLength
-        try:
-            meta = youtube_dl.YoutubeDL(ydl_opts).extract_info(_id)
-        except Exception:
+            with audio_file:
+                size = 0
+                probed = False
+                digest = hashlib.sha256()
+                for chunk in response.iter_content(DOWNLOAD_CHUNK_SIZE):
+                    size += len(chunk)
+                    download_bytes.inc(len(chunk))
+                    if size > MAX_FILE_SIZE:
+                        raise MaxFilesize
+                    audio_file.write(chunk)
+                    digest.update(chunk)
+                    if not probed and size >= PROBE_HEAD_SIZE:
+                        probed = True
+                        audio_file.flush()
+                        length = estimate_audio_length(audio_file.name, total_size)
+                        logger.debug(f"Estimated {length=} for {url=}")
+                        if length and length > MAX_AUDIO_LENGTH:
+                            raise MaxAudioLength
+        except requests.RequestException:
+            os.remove(audio_file.name)
             raise FailedToDownload
-        save_location = meta['id'] + ".mp3"
-        return move_file(tmpdir + "/" + save_location, meta['title'], out_dir, ".mp3")
+        except BaseException:
+            os.remove(audio_file.name)
+            raise
+    return audio_file.name, digest.hexdigest()
 
 
 def download_audio(url: str, out_dir: str):
+    with download_seconds.time(source="http") as labels:
+        try:
+            return _download_audio(url, out_dir, labels)
+        except Exception as e:
+            download_errors.inc(source=labels["source"], error=type(e).__name__)
+            raise
+
+
+def _download_audio(url: str, out_dir: str, labels: dict):
+    keys = source_keys(url)
+    cached = library.lookup(keys)
+    if cached:
+        labels["source"] = "cache"
+        return cached
     if ".".join(urlparse(url).netloc.split(".")[-2:]) in YT_VALID_VIDEO_DOMAINS:
+        # Includes transcoding to mp3
+        labels["source"] = "youtube"
         return_path = yt_download_audio(url, out_dir)
     else:
         filename = url.split("/")[-1]
         if not allowed_file(filename):
             raise ExtensionNotAllowed
         suffix = "." + filename.split(".")[-1]
-        audio_path = tempfile.NamedTemporaryFile(delete=False, suffix=suffix)
-        try:
-            if subprocess.call(["curl", url, "--max-filesize", str(MAX_FILE_SIZE), "--output", audio_path.name]):
-                raise MaxFilesize
-        except Exception:
-            raise FailedToDownload
-        print("Downloaded file: {}".format(audio_path.name))
+        audio_path, digest = http_download_audio(url, suffix)
+        logger.info(f"Downloaded file: {audio_path}")
 
         try:
-            if get_audio_length(audio_path.name) > MAX_AUDIO_LENGTH:
-                os.remove(audio_path.name)
-                raise MaxAudioLength
-        except Exception:
-            os.remove(audio_path.name)
+            length = get_audio_length(audio_path)
+        except ProbeError:
+            os.remove(audio_path)
             raise FailedToProcess
+        if length > MAX_AUDIO_LENGTH:
+            os.remove(audio_path)
+            raise MaxAudioLength
         return_path = move_file(
-            audio_path.name, filename[:-len(suffix)], out_dir, suffix)
+            audio_path, filename[:-len(suffix)], out_dir, suffix, digest)
+    library.remember(keys, return_path)
     return return_path
 
 
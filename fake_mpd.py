@@ -0,0 +1,468 @@
+################################################################################
+#      ____  ___    ____  ________     ____  ____  ______
+#     / __ \/   |  / __ \/  _/ __ \   / __ )/ __ \/_  __/
+#    / /_/ / /| | / / / // // / / /  / __  / / / / / /
+#   / _, _/ ___ |/ /_/ // // /_/ /  / /_/ / /_/ / / /
+#  /_/ |_/_/  |_/_____/___/\____/  /_____/\____/ /_/
+#
+#
+# Matheus Fillipe 18/05/2022
+# MIT License
+################################################################################
+
+
+import logging
+import os
+import shlex
+import sys
+import time
+from dataclasses import dataclass, field
+from functools import partial
+from typing import Dict, List, Set
+
+import mpd
+import trio
+
+from mpd_client import LineReader
+
+PROTOCOL_VERSION = "0.23.5"
+SUBSYSTEMS = ["database", "update", "stored_playlist", "playlist", "player",
+              "mixer", "output", "options", "partition", "sticker",
+              "subscription", "message", "neighbor", "mount"]
+# Mimics mpd's "ACK [error@command_listNum] {current_command} message_text"
+ACK_ARG = 2
+ACK_NO_EXIST = 50
+
+logger = logging.getLogger()
+
+
+class CommandError(Exception):
+    def __init__(self, code: int, text: str):
+        super().__init__(text)
+        self.code = code
+        self.text = text
+
+
+@dataclass
+class FakeSong:
+    id: int
+    file: str
+    duration: float
+    version: int
+
+
+@dataclass
+class FakeClient:
+    idle: Set[str] = field(default_factory=set)
+    pending: Set[str] = field(default_factory=set)
+    event: trio.Event = field(default_factory=trio.Event)
+
+
+class FakeMPD:
+    """Small in-memory mpd that speaks enough of the protocol for the bot.
+
+    It implements ``status``, ``currentsong``, ``playlistinfo``,
+    ``playlistid``, ``plchanges``, ``plchangesposid``, ``add``, ``addid``,
+    ``move``, ``moveid``, ``delete``, ``deleteid``, ``update``, ``idle``,
+    ``noidle``, player controls and command lists. ``latency`` seconds are
+    slept before every response to emulate a slow server and files only get
+    into the database once an ``update`` for them ran, like real mpd. With
+    a music_dir, ``update`` rescans it on disk and drops deleted files.
+    """
+
+    def __init__(self, library: Dict[str, float] = None, latency: float = 0,
+                 update_delay: float = 0, music_dir: str = None):
+        # uri -> duration in seconds
+        self.library = dict(library or {})
+        self.database = set(self.library)
+        self.music_dir = music_dir
+        self.latency = latency
+        self.update_delay = update_delay
+        self.playlist: List[FakeSong] = []
+        self.version = 1
+        self.next_id = 1
+        self.current = None
+        self.state = "stop"
+        self.update_job = 0
+        self.updating = False
+        self.clients: List[FakeClient] = []
+        self.commands = 0
+        self.port = None
+        self._nursery = None
+
+    def notify(self, *subsystems: str):
+        for client in self.clients:
+            client.pending.update(subsystems)
+            if client.pending & client.idle:
+                client.event.set()
+
+    def _touch_playlist(self, start: int = 0):
+        self.version += 1
+        for song in self.playlist[start:]:
+            song.version = self.version
+        self.notify("playlist")
+
+    def _song_info(self, song: FakeSong, pos: int) -> List[str]:
+        return [f"file: {song.file}",
+                f"Time: {int(song.duration)}",
+                f"duration: {song.duration:.3f}",
+                f"Pos: {pos}",
+                f"Id: {song.id}"]
+
+    def _pos_of_id(self, id: int) -> int:
+        for pos, song in enumerate(self.playlist):
+            if song.id == id:
+                return pos
+        raise CommandError(ACK_NO_EXIST, "No such song")
+
+    def _range(self, arg: str):
+        try:
+            if ":" in arg:
+                start, end = arg.split(":")
+                start = int(start)
+                end = int(end) if end else len(self.playlist)
+            else:
+                start = int(arg)
+                end = start + 1
+        except ValueError:
+            raise CommandError(ACK_ARG, "Integer expected")
+        if start < 0 or start >= len(self.playlist) or end < start:
+            raise CommandError(ACK_ARG, "Bad song index")
+        return start, min(end, len(self.playlist))
+
+    def _insert(self, uri: str, pos: int = None) -> FakeSong:
+        if uri not in self.database:
+            raise CommandError(ACK_NO_EXIST, "No such directory")
+        if pos is None:
+            pos = len(self.playlist)
+        if pos < 0 or pos > len(self.playlist):
+            raise CommandError(ACK_ARG, "Bad song index")
+        song = FakeSong(self.next_id, uri, self.library.get(uri, 180.0), 0)
+        self.next_id += 1
+        self.playlist.insert(pos, song)
+        if self.current is not None and pos <= self.current:
+            self.current += 1
+        self._touch_playlist(pos)
+        return song
+
+    def _remove(self, start: int, end: int):
+        del self.playlist[start:end]
+        if self.current is not None:
+            if start <= self.current < end:
+                self.current = start if start < len(self.playlist) else None
+                if self.current is None:
+                    self.state = "stop"
+                self.notify("player")
+            elif self.current >= end:
+                self.current -= end - start
+        self._touch_playlist(start)
+
+    def _move(self, start: int, end: int, to: int):
+        songs = self.playlist[start:end]
+        current = self.playlist[self.current] if self.current is not None else None
+        del self.playlist[start:end]
+        if to < 0 or to > len(self.playlist):
+            self.playlist[start:start] = songs
+            raise CommandError(ACK_ARG, "Bad song index")
+        self.playlist[to:to] = songs
+        if current is not None:
+            self.current = self.playlist.index(current)
+        self._touch_playlist(min(start, to))
+
+    def _play(self, pos: int):
+        if pos is None or pos >= len(self.playlist) or pos < 0:
+            self.current = None
+            self.state = "stop"
+        else:
+            self.current = pos
+            self.state = "play"
+        self.notify("player")
+
+    def _scan(self, uri: str) -> Set[str]:
+        """Uris of the files under uri in music_dir."""
+        found = set()
+        for root, _, files in os.walk(os.path.join(self.music_dir, uri)):
+            for name in files:
+                found.add(os.path.relpath(os.path.join(root, name), self.music_dir))
+        return found
+
+    async def _finish_update(self, uri: str, uris: Set[str], job: int):
+        await trio.sleep(self.update_delay)
+        if self.music_dir is not None:
+            self.database = {u for u in self.database if not u.startswith(uri)}
+        self.database |= uris
+        if self.update_job == job:
+            self.updating = False
+        self.notify("update", "database")
+
+    def cmd_ping(self):
+        return []
+
+    def cmd_status(self):
+        lines = ["volume: 100", "repeat: 1", "random: 0", "single: 0",
+                 "consume: 0", f"playlist: {self.version}",
+                 f"playlistlength: {len(self.playlist)}", f"state: {self.state}"]
+        if self.current is not None:
+            song = self.playlist[self.current]
+            lines += [f"song: {self.current}", f"songid: {song.id}",
+                      "elapsed: 1.000", f"duration: {song.duration:.3f}"]
+            if self.current + 1 < len(self.playlist):
+                nxt = self.playlist[self.current + 1]
+                lines += [f"nextsong: {self.current + 1}", f"nextsongid: {nxt.id}"]
+        if self.updating:
+            lines.append(f"updating_db: {self.update_job}")
+        return lines
+
+    def cmd_currentsong(self):
+        if self.current is None:
+            return []
+        return self._song_info(self.playlist[self.current], self.current)
+
+    def cmd_playlistinfo(self, arg: str = None):
+        if arg is None:
+            start, end = 0, len(self.playlist)
+        else:
+            start, end = self._range(arg)
+        lines = []
+        for pos in range(start, end):
+            lines += self._song_info(self.playlist[pos], pos)
+        return lines
+
+    def cmd_playlistid(self, id: str = None):
+        if id is None:
+            return self.cmd_playlistinfo()
+        pos = self._pos_of_id(int(id))
+        return self._song_info(self.playlist[pos], pos)
+
+    def cmd_plchanges(self, version: str, window: str = None):
+        version = int(version)
+        return [line for pos, song in enumerate(self.playlist) if song.version > version
+                for line in self._song_info(song, pos)]
+
+    def cmd_plchangesposid(self, version: str, window: str = None):
+        version = int(version)
+        return [line for pos, song in enumerate(self.playlist) if song.version > version
+                for line in (f"cpos: {pos}", f"Id: {song.id}")]
+
+    def cmd_add(self, uri: str, pos: str = None):
+        self._insert(uri, None if pos is None else int(pos))
+        return []
+
+    def cmd_addid(self, uri: str, pos: str = None):
+        song = self._insert(uri, None if pos is None else int(pos))
+        return [f"Id: {song.id}"]
+
+    def cmd_delete(self, arg: str):
+        self._remove(*self._range(arg))
+        return []
+
+    def cmd_deleteid(self, id: str):
+        pos = self._pos_of_id(int(id))
+        self._remove(pos, pos + 1)
+        return []
+
+    def cmd_move(self, arg: str, to: str):
+        start, end = self._range(arg)
+        self._move(start, end, int(to))
+        return []
+
+    def cmd_moveid(self, id: str, to: str):
+        pos = self._pos_of_id(int(id))
+        self._move(pos, pos + 1, int(to))
+        return []
+
+    def cmd_clear(self):
+        self._remove(0, len(self.playlist))
+        return []
+
+    def cmd_update(self, uri: str = ""):
+        if self.music_dir is not None:
+            uris = self._scan(uri)
+        else:
+            uris = {u for u in self.library if u.startswith(uri)}
+        self.update_job += 1
+        self.updating = True
+        self.notify("update")
+        self._nursery.start_soon(self._finish_update, uri, uris, self.update_job)
+        return [f"updating_db: {self.update_job}"]
+
+    def cmd_play(self, pos: str = None):
+        self._play(int(pos) if pos is not None else (self.current or 0))
+        return []
+
+    def cmd_playid(self, id: str):
+        self._play(self._pos_of_id(int(id)))
+        return []
+
+    def cmd_next(self):
+        if self.current is not None:
+            self._play(self.current + 1)
+        return []
+
+    def cmd_previous(self):
+        if self.current is not None:
+            self._play(max(self.current - 1, 0))
+        return []
+
+    def cmd_stop(self):
+        self.state = "stop"
+        self.notify("player")
+        return []
+
+    def run_command(self, line: str) -> List[str]:
+        try:
+            name, *args = shlex.split(line)
+        except ValueError:
+            raise CommandError(ACK_ARG, "Invalid quoting")
+        handler = getattr(self, f"cmd_{name}", None)
+        if handler is None:
+            raise CommandError(5, f"unknown command \"{name}\"")
+        self.commands += 1
+        try:
+            return handler(*args)
+        except TypeError:
+            raise CommandError(ACK_ARG, "wrong number of arguments")
+
+    async def _idle(self, stream: trio.SocketStream, client: FakeClient,
+                    args: List[str], lines: LineReader):
+        client.idle = set(args) if args else set(SUBSYSTEMS)
+        async with trio.open_nursery() as nursery:
+            async def wait_noidle():
+                try:
+                    await lines.readline()
+                except mpd.ConnectionError:
+                    pass
+                # noidle or connection closed
+                client.event.set()
+            nursery.start_soon(wait_noidle)
+            if not client.pending & client.idle:
+                client.event = trio.Event()
+                await client.event.wait()
+            nursery.cancel_scope.cancel()
+        changed = sorted(client.pending & client.idle)
+        client.pending -= client.idle
+        client.idle = set()
+        client.event = trio.Event()
+        await stream.send_all(
+            "".join(f"changed: {s}\n" for s in changed).encode() + b"OK\n")
+
+    async def handle(self, stream: trio.SocketStream):
+        client = FakeClient()
+        self.clients.append(client)
+        lines = LineReader(stream)
+        try:
+            await stream.send_all(f"OK MPD {PROTOCOL_VERSION}\n".encode())
+            command_list = None
+            list_ok = False
+            while True:
+                line = await lines.readline()
+                if line == "close":
+                    return
+                if line == "command_list_begin" or line == "command_list_ok_begin":
+                    command_list = []
+                    list_ok = line == "command_list_ok_begin"
+                    continue
+                if command_list is not None and line != "command_list_end":
+                    command_list.append(line)
+                    continue
+                await trio.sleep(self.latency)
+                if line.startswith("idle"):
+                    await self._idle(stream, client, line.split()[1:], lines)
+                    continue
+                if line == "noidle":
+                    continue
+                batch = command_list if command_list is not None else [line]
+                command_list = None
+                out = []
+                for i, cmd in enumerate(batch):
+                    try:
+                        out += self.run_command(cmd)
+                    except CommandError as e:
+                        name = cmd.split(" ")[0]
+                        out.append(f"ACK [{e.code}@{i}] {{{name}}} {e.text}")
+                        break
+                    if list_ok and line == "command_list_end":
+                        out.append("list_OK")
+                else:
+                    out.append("OK")
+                list_ok = False
+                await stream.send_all("".join(f"{o}\n" for o in out).encode())
+        except (trio.BrokenResourceError, trio.ClosedResourceError, mpd.ConnectionError):
+            pass
+        finally:
+            self.clients.remove(client)
+
+    async def serve(self, port: int = 0, task_status=trio.TASK_STATUS_IGNORED):
+        """Serve on localhost, reporting the bound port through
+        ``nursery.start``."""
+        async with trio.open_nursery() as nursery:
+            self._nursery = nursery
+            listeners = await nursery.start(
+                partial(trio.serve_tcp, self.handle, port, host="127.0.0.1"))
+            self.port = listeners[0].socket.getsockname()[1]
+            task_status.started(self.port)
+
+
+async def load_test(clients: int = 16, commands: int = 200, latency: float = 0.001,
+                    songs: int = 500):
+    """Hammer a fake mpd with the bot's sync and async clients at once,
+    printing the throughput and latency percentiles."""
+    from metrics import registry
+    from mpd_client import AsyncMPDClient, MPDClient
+
+    library = {f"load/{i}.mp3": 180.0 + i for i in range(songs)}
+    uris = list(library)
+    fake = FakeMPD(library, latency)
+    async with trio.open_nursery() as nursery:
+        port = await nursery.start(fake.serve)
+        client = MPDClient("127.0.0.1", port)
+        await trio.to_thread.run_sync(
+            lambda: client.batch(*[("add", uri) for uri in uris[:songs // 2]], ("play", 0)))
+
+        async def async_worker(i: int):
+            async_client = AsyncMPDClient("127.0.0.1", port)
+            for n in range(commands):
+                if n % 3 == 0:
+                    await async_client.current_song()
+                elif n % 3 == 1:
+                    await async_client.sync_playlist()
+                else:
+                    await async_client.command("status")
+            await async_client.close()
+
+        def sync_worker(i: int):
+            for n in range(commands):
+                if n % 4 == 0:
+                    id = client.add_at_pos(uris[(i * commands + n) % len(uris)], 1)
+                    client.remove_id(id)
+                elif n % 4 == 1:
+                    client.next_songs()
+                else:
+                    client.current_song()
+
+        start = time.perf_counter()
+        async with trio.open_nursery() as workers:
+            for i in range(clients):
+                workers.start_soon(async_worker, i)
+                workers.start_soon(trio.to_thread.run_sync, sync_worker, i)
+        elapsed = time.perf_counter() - start
+        nursery.cancel_scope.cancel()
+    print(f"{clients} async and {clients} sync clients, {fake.commands} commands in "
+          f"{elapsed:.2f}s: {fake.commands / elapsed:.0f} commands/s")
+    for line in registry.summary():
+        print(line)
+
+
+async def main(port: int):
+    fake = FakeMPD()
+    await fake.serve(port)
+
+
+if __name__ == "__main__":
+    # python fake_mpd.py [port] serves an empty mpd to point the bot at,
+    # python fake_mpd.py --load [clients] [commands] runs the load test
+    if sys.argv[1:2] == ["--load"]:
+        trio.run(load_test, *[int(arg) for arg in sys.argv[2:4]])
+    else:
+        logging.basicConfig(level=logging.DEBUG)
+        trio.run(main, int(sys.argv[1]) if len(sys.argv) > 1 else 6600)
@@ -0,0 +1,104 @@
+################################################################################
+#      ____  ___    ____  ________     ____  ____  ______
+#     / __ \/   |  / __ \/  _/ __ \   / __ )/ __ \/_  __/
+#    / /_/ / /| | / / / // // / / /  / __  / / / / / /
+#   / _, _/ ___ |/ /_/ // // /_/ /  / /_/ / /_/ / / /
+#  /_/ |_/_/  |_/_____/___/\____/  /_____/\____/ /_/
+#
+#
+# Matheus Fillipe 18/05/2022
+# MIT License
+################################################################################
+
+
+import logging
+import threading
+from typing import Optional
+
+import requests
+import trio
+
+# Seconds to connect and between received bytes
+TIMEOUT = 10
+MAX_BODY_SIZE = 1024**2
+CHUNK_SIZE = 16 * 1024
+PASTE_URL = "http://ix.io"
+# Form field the paste service reads the text from, None to post it raw
+PASTE_FIELD = "f:1"
+
+logger = logging.getLogger()
+_local = threading.local()
+
+
+class HTTPError(Exception):
+    pass
+
+
+class BodyTooLarge(HTTPError):
+    def __init__(self, max_size: int):
+        super().__init__(f"Response is bigger than {max_size // 1024}KB")
+
+
+def session() -> requests.Session:
+    """Session of the current thread, keeping its connections alive between
+    requests."""
+    if not hasattr(_local, "session"):
+        _local.session = requests.Session()
+    return _local.session
+
+
+def request(method: str, url: str, max_size: int = MAX_BODY_SIZE,
+            timeout: float = TIMEOUT, **kwargs) -> str:
+    """Body of the response to a request, read as it is streamed so a body
+    over max_size bytes is refused without being held in memory.
+
+    Can raise HTTPError.
+    """
+    try:
+        with session().request(method, url, stream=True, timeout=timeout, **kwargs) as response:
+            response.raise_for_status()
+            length = response.headers.get("Content-Length")
+            if length and length.isdigit() and int(length) > max_size:
+                raise BodyTooLarge(max_size)
+            body = bytearray()
+            for chunk in response.iter_content(CHUNK_SIZE):
+                body += chunk
+                if len(body) > max_size:
+                    raise BodyTooLarge(max_size)
+            return body.decode(response.encoding or "utf-8", errors="replace")
+    except requests.RequestException as e:
+        raise HTTPError(str(e))
+
+
+async def arequest(method: str, url: str, max_size: int = MAX_BODY_SIZE,
+                   timeout: float = TIMEOUT, **kwargs) -> str:
+    """request() in a worker thread. Cancelling it abandons the thread, which
+    finishes within timeout."""
+    return await trio.to_thread.run_sync(
+        lambda: request(method, url, max_size, timeout, **kwargs), cancellable=True)
+
+
+async def get_text(url: str, max_size: int = MAX_BODY_SIZE, timeout: float = TIMEOUT) -> str:
+    return await arequest("GET", url, max_size, timeout)
+
+
+class Paster:
+    """Uploads text to a paste service answering with the paste's url."""
+
+    def __init__(self, url: str = PASTE_URL, field: Optional[str] = PASTE_FIELD,
+                 timeout: float = TIMEOUT):
+        self.url = url
+        self.field = field
+        self.timeout = timeout
+
+    async def paste(self, text: str) -> str:
+        """Url of a new paste of text. Can raise HTTPError."""
+        logger.debug(f"Pasting {len(text)} characters to {self.url}")
+        if self.field:
+            kwargs = {"data": {self.field: text}}
+        else:
+            kwargs = {"data": text.encode()}
+        url = (await arequest("POST", self.url, timeout=self.timeout, **kwargs)).strip()
+        if not url.startswith("http"):
+            raise HTTPError(f"Unexpected paste service response: {url[:100]}")
+        return url
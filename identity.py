@@ -0,0 +1,170 @@
+################################################################################
+#      ____  ___    ____  ________     ____  ____  ______
+#     / __ \/   |  / __ \/  _/ __ \   / __ )/ __ \/_  __/
+#    / /_/ / /| | / / / // // / / /  / __  / / / / / /
+#   / _, _/ ___ |/ /_/ // // /_/ /  / /_/ / /_/ / / /
+#  /_/ |_/_/  |_/_____/___/\____/  /_____/\____/ /_/
+#
+#
+# Matheus Fillipe 18/05/2022
+# MIT License
+################################################################################
+
+
+import logging
+import re
+from typing import Dict, Optional, Set
+
+import trio
+from cachetools import TLRUCache
+from IrcBot.bot import IrcBot
+
+from metrics import registry
+
+CAPABILITIES = ["account-notify", "extended-join", "account-tag"]
+AUTH_CACHE_SIZE = 4096
+# Seconds an account is trusted without hearing from the server again
+AUTH_CACHE_TTL = 600
+# Unidentified users may identify at any moment, without account-notify we
+# wouldn't know
+NEGATIVE_CACHE_TTL = 15
+IDENTIFY_TIMEOUT = 5
+NICKSERV = "NickServ"
+# Token tagging our WHOX queries
+WHOX_TOKEN = "417"
+
+SOURCE_RE = re.compile(r"^:([^!@\s]+)(?:!\S*)?\s+(\S+)\s*(.*)$")
+
+logger = logging.getLogger()
+lookup_seconds = registry.histogram(
+    "mpdbot_account_lookup_seconds", "Time to learn the account of a nick, by where it came from")
+lookup_timeouts = registry.counter(
+    "mpdbot_account_lookup_timeouts_total", "Account lookups the server didn't answer in time")
+
+
+def parse_tags(raw: str) -> Dict[str, str]:
+    tags = {}
+    for tag in raw.split(";"):
+        key, _, value = tag.partition("=")
+        tags[key] = value
+    return tags
+
+
+class AccountBot(IrcBot):
+    """IrcBot that knows which services account each nick is logged into.
+
+    Accounts are learned for free from the IRCv3 account-notify,
+    extended-join and account-tag capabilities when the server has them,
+    so most commands are answered without asking anything. Otherwise a
+    WHOX query, or a NickServ STATUS one as a last resort, is sent, with
+    concurrent lookups for the same nick sharing it. Answers, including
+    "not logged in", are kept in one bounded cache that NICK and QUIT
+    invalidate.
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.accounts = TLRUCache(AUTH_CACHE_SIZE, self._ttu)
+        self.capabilities: Set[str] = set()
+        self.whox = False
+        self._lookups: Dict[str, trio.Event] = {}
+
+    @staticmethod
+    def _ttu(_key, account, now):
+        return now + (AUTH_CACHE_TTL if account else NEGATIVE_CACHE_TTL)
+
+    async def request_capabilities(self):
+        """Ask for the account capabilities and server features. Call after
+        every (re)connection."""
+        self.capabilities.clear()
+        self.whox = False
+        self.accounts.clear()
+        for cap in CAPABILITIES:
+            await self.send_raw(f"CAP REQ :{cap}")
+        # Makes the server repeat its 005 ISUPPORT lines advertising WHOX
+        await self.send_raw("VERSION")
+
+    def _remember(self, nick: str, account: Optional[str]):
+        self.accounts[nick.lower()] = account
+        event = self._lookups.pop(nick.lower(), None)
+        if event is not None:
+            event.set()
+
+    def _forget(self, nick: str):
+        self.accounts.pop(nick.lower(), None)
+
+    async def data_handler(self, s, data):
+        tags = {}
+        if data.startswith("@"):
+            raw_tags, _, data = data[1:].partition(" ")
+            tags = parse_tags(raw_tags)
+        data = self._track(tags, data) or data
+        await super().data_handler(s, data)
+
+    def _track(self, tags: dict, data: str) -> Optional[str]:
+        """Learn accounts from a server line. Returns the line rewritten to
+        what IrcBot's parser understands when needed."""
+        match = SOURCE_RE.match(data)
+        if not match:
+            return None
+        source, command, params = match.groups()
+        args = params.split(" ")
+        if command == "CAP" and len(args) >= 3 and args[1] == "ACK":
+            self.capabilities.update(" ".join(args[2:]).lstrip(":").split())
+            logger.info(f"Enabled capabilities: {self.capabilities}")
+        elif command == "005" and "WHOX" in args:
+            self.whox = True
+        elif command == "354" and len(args) >= 4 and args[1] == WHOX_TOKEN:
+            self._remember(args[2], None if args[3] == "0" else args[3])
+        elif command == "315" and len(args) >= 2 and args[1].lower() in self._lookups:
+            # End of WHO without a 354 for the nick: it isn't online
+            if args[1].lower() not in self.accounts:
+                self._remember(args[1], None)
+        elif command == "NOTICE" and source.lower() == NICKSERV.lower():
+            status = re.match(r"^:?STATUS (\S+) (\d)(?: (\S+))?", " ".join(args[1:]))
+            if status:
+                nick, level, account = status.groups()
+                self._remember(nick, (account or nick) if level == "3" else None)
+        elif command == "ACCOUNT" and "account-notify" in self.capabilities:
+            self._remember(source, None if args[0] == "*" else args[0])
+        elif command == "NICK" or command == "QUIT":
+            self._forget(source)
+            if command == "NICK":
+                self._forget(args[0].lstrip(":"))
+        elif command == "JOIN" and len(args) >= 3 and "extended-join" in self.capabilities:
+            self._remember(source, None if args[1] == "*" else args[1])
+            return data.split(" ")[0] + f" JOIN {args[0]}"
+
+        from_user = "!" in data.split(" ")[0]
+        if "account-tag" in self.capabilities and from_user and command in ("PRIVMSG", "NOTICE"):
+            self._remember(source, tags.get("account"))
+        return None
+
+    async def account(self, nick: str) -> Optional[str]:
+        """Services account nick is logged into, None if it isn't or the
+        server didn't answer in time."""
+        key = nick.lower()
+        with lookup_seconds.time(source="cache") as labels:
+            account = self.accounts.get(key, False)
+            if account is not False:
+                return account
+            labels["source"] = "whox" if self.whox else "nickserv"
+            event = self._lookups.get(key)
+            if event is None:
+                event = self._lookups[key] = trio.Event()
+                if self.whox:
+                    await self.send_raw(f"WHO {nick} %tna,{WHOX_TOKEN}")
+                else:
+                    await self.send_raw(f"PRIVMSG {NICKSERV} :STATUS {nick}")
+            with trio.move_on_after(IDENTIFY_TIMEOUT):
+                await event.wait()
+            if self._lookups.get(key) is event:
+                del self._lookups[key]
+                lookup_timeouts.inc()
+                logger.warning(f"No account information for {nick=}")
+            return self.accounts.get(key)
+
+    async def is_identified(self, nick: str) -> bool:
+        """Whether nick is logged into the account of the same name."""
+        account = await self.account(nick)
+        return account is not None and account.lower() == nick.lower()
@@ -0,0 +1,201 @@
+################################################################################
+#      ____  ___    ____  ________     ____  ____  ______
+#     / __ \/   |  / __ \/  _/ __ \   / __ )/ __ \/_  __/
+#    / /_/ / /| | / / / // // / / /  / __  / / / / / /
+#   / _, _/ ___ |/ /_/ // // /_/ /  / /_/ / /_/ / / /
+#  /_/ |_/_/  |_/_____/___/\____/  /_____/\____/ /_/
+#
+#
+# Matheus Fillipe 18/05/2022
+# MIT License
+################################################################################
+
+
+import logging
+import os
+import sqlite3
+import threading
+import time
+from typing import Iterable, List, Optional
+from urllib.parse import parse_qsl, urlencode, urlparse, urlunparse
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS sources (
+    key TEXT PRIMARY KEY,
+    path TEXT NOT NULL,
+    added REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS sources_path ON sources(path);
+CREATE TABLE IF NOT EXISTS files (
+    path TEXT PRIMARY KEY,
+    sha256 TEXT NOT NULL,
+    size INTEGER NOT NULL,
+    added REAL NOT NULL,
+    last_played REAL,
+    kept INTEGER NOT NULL DEFAULT 0
+);
+CREATE INDEX IF NOT EXISTS files_sha256 ON files(sha256);
+"""
+# Columns added to tables after they were first released
+MIGRATIONS = {
+    "files": {
+        "last_played": "REAL",
+        "kept": "INTEGER NOT NULL DEFAULT 0",
+    },
+}
+
+# Bytes the stored files may take, 0 for no limit
+QUOTA = 0
+# Recently stored files are not evicted, they may still be on their way to
+# the playlist
+EVICTION_GRACE = 600
+
+# Query parameters that don't change what a url points to
+TRACKING_PARAMS = {"si", "feature", "fbclid", "gclid", "ref", "pp"}
+
+logger = logging.getLogger()
+
+
+def normalize_url(url: str) -> str:
+    """Canonical form of a url so trivially different links to the same
+    resource share a cache entry."""
+    parsed = urlparse(url.strip())
+    host = parsed.netloc.lower()
+    for prefix in ("www.", "m."):
+        if host.startswith(prefix):
+            host = host[len(prefix):]
+    query = sorted((k, v) for k, v in parse_qsl(parsed.query)
+                   if k not in TRACKING_PARAMS and not k.startswith("utm_"))
+    return urlunparse((parsed.scheme.lower(), host, parsed.path.rstrip("/"),
+                       "", urlencode(query), ""))
+
+
+class Library:
+    """Persistent index of the files the bot stored in the music folder.
+
+    Maps source keys, like ``youtube:<video id>`` or ``url:<normalized
+    url>``, to the library file they were downloaded into so repeated
+    requests skip the download entirely, and records the content hash of
+    every stored file so identical audio is only kept once. Safe to share
+    between threads.
+    """
+
+    def __init__(self, db_path: str):
+        db_path = os.path.expanduser(db_path)
+        os.makedirs(os.path.dirname(db_path) or ".", exist_ok=True)
+        self.db = sqlite3.connect(db_path, check_same_thread=False)
+        self.lock = threading.Lock()
+        with self.lock, self.db:
+            self.db.executescript(SCHEMA)
+            for table, columns in MIGRATIONS.items():
+                existing = {row[1] for row in self.db.execute(f"PRAGMA table_info({table})")}
+                for column, definition in columns.items():
+                    if column not in existing:
+                        self.db.execute(
+                            f"ALTER TABLE {table} ADD COLUMN {column} {definition}")
+
+    def lookup(self, keys: Iterable[str]) -> Optional[str]:
+        """Path of the library file stored for any of the keys. Entries
+        whose file disappeared are forgotten."""
+        for key in keys:
+            with self.lock:
+                row = self.db.execute(
+                    "SELECT path FROM sources WHERE key = ?", (key, )).fetchone()
+            if row is None:
+                continue
+            if os.path.isfile(row[0]):
+                logger.info(f"Download cache hit for {key=}: {row[0]}")
+                return row[0]
+            self.forget(row[0])
+        return None
+
+    def remember(self, keys: Iterable[str], path: str):
+        """Record that the keys resolve to path."""
+        now = time.time()
+        with self.lock, self.db:
+            self.db.executemany(
+                "INSERT OR REPLACE INTO sources (key, path, added) VALUES (?, ?, ?)",
+                [(key, path, now) for key in keys])
+
+    def forget(self, path: str):
+        """Drop every entry pointing to path."""
+        with self.lock, self.db:
+            self.db.execute("DELETE FROM sources WHERE path = ?", (path, ))
+            self.db.execute("DELETE FROM files WHERE path = ?", (path, ))
+
+    def find_hash(self, digest: str) -> Optional[str]:
+        """Path of a stored file with the given sha256, if any."""
+        with self.lock:
+            rows = self.db.execute(
+                "SELECT path FROM files WHERE sha256 = ?", (digest, )).fetchall()
+        for path, in rows:
+            if os.path.isfile(path):
+                return path
+            self.forget(path)
+        return None
+
+    def file_hash(self, path: str) -> Optional[str]:
+        """Recorded sha256 of a stored file."""
+        with self.lock:
+            row = self.db.execute(
+                "SELECT sha256 FROM files WHERE path = ?", (path, )).fetchone()
+        return row and row[0]
+
+    def add_file(self, path: str, digest: str, size: int):
+        """Record a file stored in the library."""
+        with self.lock, self.db:
+            self.db.execute(
+                "INSERT OR REPLACE INTO files (path, sha256, size, added) VALUES (?, ?, ?, ?)",
+                (path, digest, size, time.time()))
+
+    def played(self, path: str):
+        """Record that a stored file was just played."""
+        with self.lock, self.db:
+            self.db.execute(
+                "UPDATE files SET last_played = ? WHERE path = ?", (time.time(), path))
+
+    def keep(self, path: str, kept: bool = True):
+        """Mark a stored file so it is never evicted."""
+        with self.lock, self.db:
+            self.db.execute(
+                "UPDATE files SET kept = ? WHERE path = ?", (int(kept), path))
+
+    def total_size(self) -> int:
+        with self.lock:
+            return self.db.execute("SELECT COALESCE(SUM(size), 0) FROM files").fetchone()[0]
+
+    def evict(self, quota: int, protected: Iterable[str] = ()) -> List[str]:
+        """Delete the least recently played files until the stored ones fit
+        in quota bytes, returning their paths.
+
+        Kept files, the protected paths and files stored in the last
+        EVICTION_GRACE seconds are never evicted.
+        """
+        protected = set(protected)
+        with self.lock:
+            total = self.db.execute("SELECT COALESCE(SUM(size), 0) FROM files").fetchone()[0]
+            if total <= quota:
+                return []
+            rows = self.db.execute(
+                "SELECT path, size FROM files WHERE kept = 0 AND added < ? "
+                "ORDER BY COALESCE(last_played, added)",
+                (time.time() - EVICTION_GRACE, )).fetchall()
+        evicted = []
+        for path, size in rows:
+            if total <= quota:
+                break
+            if path in protected:
+                continue
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            except OSError as e:
+                logger.error(f"Failed to evict {path=}: {e}")
+                continue
+            self.forget(path)
+            total -= size
+            evicted.append(path)
+        if evicted:
+            logger.info(f"Evicted {len(evicted)} files, library now takes {total} bytes")
+        return evicted
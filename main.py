@@ -15,11 +15,9 @@ import datetime
 import logging
 import os
 import re
-from copy import deepcopy
 from pathlib import Path
 from typing import List, Union
 
-import requests
 import trio
 from cachetools import TTLCache
 from IrcBot.bot import Color, IrcBot, Message, utils
@@ -30,14 +28,28 @@ from slugify import slugify
 from audio_download import (MAX_AUDIO_LENGTH, MAX_FILE_SIZE,
                             ExtensionNotAllowed, FailedToDownload,
                             FailedToProcess, MaxAudioLength, MaxFilesize,
-                            allowed_file, download_audio, get_audio_length)
-from message_server import listen_loop
-from mpd_client import MPDClient, mpd_loop_with_handler
+                            allowed_file, download_audio, get_audio_length,
+                            library, move_file)
+from httpclient import (MAX_BODY_SIZE, PASTE_FIELD, PASTE_URL, HTTPError,
+                        Paster, get_text)
+from identity import AccountBot
+from library import QUOTA
+from message_server import Relay, listen_loop
+from metrics import METRICS_ADDRESS, METRICS_PORT, registry
+from metrics import serve as serve_metrics
+from mpd_client import (COMMAND_TIMEOUT, POOL_SIZE, AsyncMPDClient, MPDClient,
+                        format_playlist_footer, mpd_loop_with_handler)
+from output import (BULK, INTERACTIVE, PAGE_SIZE, PASTE_THRESHOLD,
+                    OutputScheduler)
 from parseconf import config
-from playlistmng import SongQueue, ThreadPool
-from sonic_pi import NoteNotFound
+from pi_scheduler import Scheduler as PiScheduler
+from pi_sessions import SessionStore
+from pi_template import Template, UnknownNotes, convert
+from playlistmng import (JOB_TIMEOUT, MAX_QUEUED_JOBS, Job, JobQueue, SongQueue,
+                         current_job, evict_downloads)
+from probe import ProbeError
+from sonic_pi import LOG_PORT, STAGING_DIR, LogListener, NoteNotFound
 from sonic_pi import Server as PiServer
-from sonic_pi import convert_to_notes
 
 LOGFILE = config["log"]["LOGFILE"]
 if LOGFILE == "None":
@@ -53,50 +65,91 @@ DCC_HOST = config["irc"]["DCC_HOST"]
 DCC_ANNOUNCE_HOST = config["irc"]["DCC_ANNOUNCE_HOST"]
 DCC_PORTS = config["irc"]["DCC_PORTS"]
 ICECAST_CONFIG = config["bot"]["ICECAST_CONFIG"]
-MESSAGE_RELAY_FIFO_PATH = config["bot"]["MESSAGE_RELAY_FIFO_PATH"]
+MESSAGE_RELAY_FIFO_PATH = config["bot"].get("MESSAGE_RELAY_FIFO_PATH")
+if MESSAGE_RELAY_FIFO_PATH == "None":
+    MESSAGE_RELAY_FIFO_PATH = None
 MPD_HOST = config["mpd"]["MPD_HOST"]
 MPD_PORT = config["mpd"]["MPD_PORT"]
 MPD_FOLDER = config["mpd"]["MPD_FOLDER"]
+MPD_POOL_SIZE = config["mpd"].get("MPD_POOL_SIZE", POOL_SIZE)
+MPD_TIMEOUT = config["mpd"].get("MPD_TIMEOUT", COMMAND_TIMEOUT)
 MAX_USER_QUEUE_LENGTH = config["mpd"]["MAX_USER_QUEUE_LENGTH"]
 MAX_DOWNLOAD_THREADS = config["download"]["MAX_DOWNLOAD_THREADS"]
+MAX_QUEUED_DOWNLOADS = config["download"].get("MAX_QUEUED_DOWNLOADS", MAX_QUEUED_JOBS)
+DOWNLOAD_TIMEOUT = config["download"].get("DOWNLOAD_TIMEOUT", JOB_TIMEOUT)
+LIBRARY_QUOTA = config["download"].get("LIBRARY_QUOTA", QUOTA)
 SONIC_PI_HOST = config["sonic-pi"]["SONIC_PI_HOST"]
 SONIC_PI_PORT = config["sonic-pi"]["SONIC_PI_PORT"]
 SONIC_PI_LIVE_URL = config["sonic-pi"]["SONIC_PI_LIVE_URL"]
+SONIC_PI_HISTORY_FILE = config["sonic-pi"].get("SONIC_PI_HISTORY_FILE")
+if SONIC_PI_HISTORY_FILE == "None":
+    SONIC_PI_HISTORY_FILE = None
+SONIC_PI_STAGING_DIR = config["sonic-pi"].get("SONIC_PI_STAGING_DIR", STAGING_DIR)
+if SONIC_PI_STAGING_DIR == "None":
+    SONIC_PI_STAGING_DIR = None
+SONIC_PI_LOG_PORT = config["sonic-pi"].get("SONIC_PI_LOG_PORT", LOG_PORT)
+if SONIC_PI_LOG_PORT == "None":
+    SONIC_PI_LOG_PORT = None
 PREFIX = config["bot"]["PREFIX"]
+PASTE_SERVICE_URL = config["bot"].get("PASTE_URL", PASTE_URL)
+PASTE_SERVICE_FIELD = config["bot"].get("PASTE_FIELD", PASTE_FIELD)
+MAX_READ_SIZE = config["bot"].get("MAX_READ_SIZE", MAX_BODY_SIZE)
+FULLLIST_PAGE_SIZE = config["bot"].get("FULLLIST_PAGE_SIZE", PAGE_SIZE)
+FULLLIST_PASTE_THRESHOLD = config["bot"].get("FULLLIST_PASTE_THRESHOLD", PASTE_THRESHOLD)
+METRICS_HOST = config["bot"].get("METRICS_HOST", METRICS_ADDRESS)
+METRICS_HTTP_PORT = config["bot"].get("METRICS_PORT", METRICS_PORT)
+if METRICS_HTTP_PORT == "None":
+    METRICS_HTTP_PORT = None
 
 
 utils.setPrefix(PREFIX)
 
 logger = utils.logger
-mpd_client = MPDClient(MPD_HOST, MPD_PORT)
-nick_cache = {}
+mpd_client = MPDClient(MPD_HOST, MPD_PORT, MPD_POOL_SIZE)
+mpd_async = AsyncMPDClient(MPD_HOST, MPD_PORT, MPD_TIMEOUT)
+# Paste urls of the formatted playlist by playlist version
+playlist_pastes = TTLCache(16, 3600)
 song_queue = SongQueue(MAX_USER_QUEUE_LENGTH, mpd_client)
-thread_pool = ThreadPool(4)
-server = PiServer(SONIC_PI_HOST, SONIC_PI_PORT, None, None, True)
-sonic_pi_users = {}
-sonic_pi_history = {}
-
-
-def paste(text):
-    """Paste text to ix.io."""
-    logger.debug(f"Pasting {text=}")
-    url = "http://ix.io"
-    payload = {'f:1=<-': text}
-    response = requests.request("POST", url, data=payload)
-    return response.text
+download_queue = JobQueue(MAX_DOWNLOAD_THREADS, MAX_QUEUED_DOWNLOADS, DOWNLOAD_TIMEOUT)
+relay = Relay()
+paster = Paster(PASTE_SERVICE_URL, PASTE_SERVICE_FIELD or None)
+output = OutputScheduler()
+server = PiServer(SONIC_PI_HOST, SONIC_PI_PORT, None, None, True,
+                  staging_dir=SONIC_PI_STAGING_DIR and os.path.expanduser(SONIC_PI_STAGING_DIR))
+pi_sessions = SessionStore(SONIC_PI_HISTORY_FILE)
+pi_logs = LogListener(SONIC_PI_LOG_PORT) if SONIC_PI_LOG_PORT else None
+pi_scheduler = PiScheduler(server, pi_logs)
+dcc_seconds = registry.histogram("mpdbot_dcc_transfer_seconds", "Time to receive a dcc upload, by outcome")
+dcc_bytes = registry.counter("mpdbot_dcc_bytes_total", "Bytes received through dcc uploads")
+
+
+def library_path(uri: str) -> str:
+    """Path on disk of a song uri, which mpd makes relative to MPD_FOLDER."""
+    return os.path.normpath(os.path.join(os.path.expanduser(MPD_FOLDER), uri))
+
+
+def enforce_quota():
+    """Evict the least recently played downloads that aren't in the playlist
+    until the library fits in LIBRARY_QUOTA, then rescan the bot's folder
+    once."""
+    if not LIBRARY_QUOTA:
+        return
+    evict_downloads(library, mpd_client, LIBRARY_QUOTA, MPD_FOLDER, NICK)
 
 
-def read_paste(url):
-    """Read text from ix.io."""
-    response = requests.request("GET", url)
-    return response.text
+def on_player_event():
+    song_queue.update()
+    current = mpd_client.cmd("currentsong")
+    if "file" in current:
+        library.played(library_path(current["file"]))
+    enforce_quota()
 
 
 def auth_command(*m_args, **m_kwargs):
     def wrap_cmd(func):
         @utils.arg_command(*m_args, **m_kwargs)
-        async def wrapped(bot: IrcBot, args: re.Match, msg: Message):
-            if not await is_identified(bot, msg.nick):
+        async def wrapped(bot: AccountBot, args: re.Match, msg: Message):
+            if not await bot.is_identified(msg.nick):
                 await reply(bot, msg, error("You cannot use this bot before you register your nick"))
                 return
             return await func(bot, args, msg)
@@ -107,8 +160,8 @@ def auth_command(*m_args, **m_kwargs):
 def admin_command(*m_args, **m_kwargs):
     def wrap_cmd(func):
         @utils.arg_command(*m_args, **m_kwargs)
-        async def wrapped(bot: IrcBot, args: re.Match, msg: Message):
-            if not await is_identified(bot, msg.nick):
+        async def wrapped(bot: AccountBot, args: re.Match, msg: Message):
+            if not await bot.is_identified(msg.nick):
                 await reply(bot, msg, error("You cannot use this bot before you register your nick"))
                 return
             if msg.nick not in ADMINS:
@@ -123,27 +176,6 @@ def non_numeric_arg(args: re.Match, i: int):
     return not args or not args.group(i) or not args.group(i).isdigit()
 
 
-async def is_identified(bot: IrcBot, nick: str) -> bool:
-    global nick_cache
-    nickserv = "NickServ"
-    if nick in nick_cache and "status" in nick_cache[nick]:
-        msg = nick_cache[nick]["status"]
-    else:
-        await bot.send_message(f"status {nick}", nickserv)
-        # We need filter because multiple notices from nickserv can come at the same time
-        # if multiple requests are being made to this function all together
-        msg = await bot.wait_for(
-            "notice",
-            nickserv,
-            timeout=5,
-            cache_ttl=15,
-            filter_func=lambda m: nick in m["text"],
-        )
-        nick_cache[nick] = TTLCache(128, 10)
-        nick_cache[nick]["status"] = msg
-    return msg.get("text").strip() == f"{nick} 3 {nick}" if msg else False
-
-
 def _reply_str(bot: IrcBot, in_msg: Message, text: str):
     return f"{Color('(' + in_msg.nick + '):', fg=Color.green).str} {text}"
 
@@ -152,22 +184,33 @@ def error(text: str):
     return Color(text, fg=Color.red).str
 
 
-async def reply(bot: IrcBot, in_msg: Message, message: Union[str, List[str]]):
-    """Reply to a message."""
-    if isinstance(message, str):
-        message = [message]
-    for text in message:
-        msg = _reply_str(bot, in_msg, text)
-        await bot.send_message(msg, channel=in_msg.channel)
+async def submit_pi_code(bot: IrcBot, msg: Message, code: str) -> bool:
+    """Queue code for sonic pi, replying if it can't be."""
+    try:
+        waiting = pi_scheduler.submit(msg.nick, msg.channel, code)
+    except PiScheduler.QueueFull as e:
+        await reply(bot, msg, error(f"{e}, wait for them to be sent"))
+        return False
+    if waiting:
+        await reply(bot, msg, f"Your code will be sent after {waiting} other programs")
+    return True
+
+
+async def reply(bot: IrcBot, in_msg: Message, message: Union[str, List[str]], bulk: bool = False):
+    """Reply to a message.
 
+    Bulk replies are packed into as few lines as possible and only sent
+    when no interactive reply is waiting.
+    """
+    output.send(in_msg.channel, message, BULK if bulk else INTERACTIVE,
+                prefix=_reply_str(bot, in_msg, ""), packed=bulk)
 
-def sync_write_fifo(text):
-    with open(MESSAGE_RELAY_FIFO_PATH, "w") as f:
-        f.write(text)
 
+def download_in_thread(bot: IrcBot, in_msg: Message, url: str) -> Job:
+    """Queue a download for the worker threads.
 
-def download_in_thread(bot: IrcBot, in_msg: Message, url: str):
-    """Download a file in a thread."""
+    Can raise JobQueue.FullError.
+    """
 
     def download_in_thread_target(song_url: str):
         err = None
@@ -186,9 +229,12 @@ def download_in_thread(bot: IrcBot, in_msg: Message, url: str):
         except Exception as e:
             err = error("Sorry but an error occurred.")
             logger.error(e)
+        if current_job().cancelled.is_set():
+            logger.info(f"Dropping cancelled download of {song_url=}")
+            return
         if err:
             err = _reply_str(bot, in_msg, err)
-            sync_write_fifo(f"[[{in_msg.channel}]] {err}")
+            relay.post(in_msg.channel, err)
             return
 
         uri = os.path.join(NICK, Path(song).name)
@@ -213,26 +259,63 @@ def download_in_thread(bot: IrcBot, in_msg: Message, url: str):
                 onend_text = _reply_str(bot, in_msg, error(
                     "Sorry but an error occurred."))
 
-        sync_write_fifo(f"[[{in_msg.channel}]] {onend_text}")
+        relay.post(in_msg.channel, onend_text)
+        enforce_quota()
+
+    def on_timeout(job: Job):
+        err = _reply_str(bot, in_msg, error(
+            f"Downloading {url} took too long and was cancelled"))
+        relay.post(in_msg.channel, err)
 
-    thread_pool.add_task(download_in_thread_target, url)
+    return download_queue.submit(in_msg.nick, download_in_thread_target, url, on_timeout=on_timeout)
 
 
 @auth_command("status", "Info about the current song and player status")
 async def status(bot: IrcBot, args: re.Match, msg: Message):
-    song = mpd_client.current_song()
+    song = await mpd_async.current_song()
     await reply(bot, msg, song)
 
 
 @auth_command("list", "Shows next songs in queue")
 async def list(bot: IrcBot, args: re.Match, msg: Message):
-    await reply(bot, msg, mpd_client.next_songs())
+    await reply(bot, msg, await mpd_async.next_songs())
 
 
-@auth_command("fulllist", "Shows all the songs in the playlist", "You will receive a DM from the bot")
+@auth_command("fulllist", "Shows all the songs in the playlist", f"{PREFIX}fulllist [page|+pos] You will receive a DM from the bot. Long playlists are pasted unless you ask for a page or a position to start from")
 async def fullist(bot: IrcBot, args: re.Match, msg: Message):
+    args = utils.m2list(args)
     msg.channel = msg.nick
-    await reply(bot, msg, mpd_client.playlist())
+    version, songs, duration = await mpd_async.playlist_snapshot()
+    footer = format_playlist_footer(duration, len(songs))
+    if not args:
+        if len(songs) <= FULLLIST_PASTE_THRESHOLD:
+            await reply(bot, msg, songs + footer, bulk=True)
+            return
+        url = playlist_pastes.get(version)
+        if url is None:
+            try:
+                url = await paster.paste("\n".join(songs + footer))
+                playlist_pastes[version] = url
+            except HTTPError as e:
+                logger.error(f"Failed to paste the playlist: {e}")
+        if url:
+            await reply(bot, msg, f"The playlist has {len(songs)} songs: {url}")
+            return
+        args = ["1"]
+
+    if args[0].startswith("+") and args[0][1:].isdigit():
+        start = int(args[0][1:])
+    elif args[0].isdigit() and int(args[0]) > 0:
+        start = (int(args[0]) - 1) * FULLLIST_PAGE_SIZE
+    else:
+        await reply(bot, msg, error("Specify a page number or +<position> to start from"))
+        return
+    pages = max(1, (len(songs) + FULLLIST_PAGE_SIZE - 1) // FULLLIST_PAGE_SIZE)
+    if start >= max(1, len(songs)):
+        await reply(bot, msg, error(f"The playlist only has {pages} pages"))
+        return
+    page = songs[start:start + FULLLIST_PAGE_SIZE]
+    await reply(bot, msg, page + [f"Page {start // FULLLIST_PAGE_SIZE + 1}/{pages}"] + footer, bulk=True)
 
 
 @auth_command("add", "Add a song to the playlist", f"{PREFIX}add <youtube_link|audio_url>. You can also submit audios with dcc. You cannot enqueue more than {MAX_USER_QUEUE_LENGTH} audios.")
@@ -252,18 +335,32 @@ async def add(bot: IrcBot, args: re.Match, msg: Message):
         return
 
     nick = msg.nick
-    if not song_queue.can_add(nick):
-        await bot.send_message(
-            f"You cannot add more than {MAX_USER_QUEUE_LENGTH} audios. Wait for one of your songs to finish and try again.",
+    if not song_queue.can_add(nick, len(download_queue.user_jobs(nick))):
+        output.send(
             msg.channel,
+            f"You cannot add more than {MAX_USER_QUEUE_LENGTH} audios. Wait for one of your songs to finish and try again.",
         )
         return
 
     try:
-        download_in_thread(bot, msg, song_url)
+        job = download_in_thread(bot, msg, song_url)
+    except JobQueue.FullError:
+        await reply(bot, msg, error("The download queue is full. Try again soon."))
+        return
+    position = download_queue.position(job)
+    if position:
+        await reply(bot, msg, f"Queued for download at position {position}. Use {PREFIX}cancel to give up.")
+    else:
         await reply(bot, msg, "Downloading...")
-    except ThreadPool.FullError:
-        await reply(bot, msg, error("The bot is currently busy downloading other songs. Try again soon."))
+
+
+@auth_command("cancel", "Cancels your pending downloads")
+async def cancel(bot: IrcBot, args: re.Match, msg: Message):
+    jobs = download_queue.cancel(msg.nick)
+    if not jobs:
+        await reply(bot, msg, error("You have no pending downloads"))
+        return
+    await reply(bot, msg, f"Cancelled {len(jobs)} download(s)")
 
 
 @auth_command("grab", "Grab the mic! Get an icecast password to start streaming", f"{PREFIX}grab - A password will be generated and you will get all the info as a dm.")
@@ -272,59 +369,25 @@ async def grab(bot: IrcBot, args: re.Match, msg: Message):
     return "Not implemented"
 
 
-def convert(*args):
-    transpose = 0
-    if args[0].isdigit():
-        octave = int(args[0])
-        if args[1][0] in ["+", "-"] and args[1][1:].isdigit():
-            transpose = int(args[1])
-            letters = "".join(args[2:])
-        else:
-            letters = "".join(args[1:])
-    else:
-        octave = 4
-        if args[0][0] in ["+", "-"] and args[0][1:].isdigit():
-            transpose = int(args[0])
-            letters = "".join(args[1:])
-        else:
-            letters = "".join(args)
-        logger.debug(f"{octave=} {letters=}")
-        return ", ".join(convert_to_notes(letters, octave, transpose))
-
-
 @auth_command("pi", "Toggles sonic pi repl", f"{PREFIX}pi [command]- https://sonic-pi.net/tutorial.html")
 async def pi(bot: IrcBot, args: re.Match, msg: Message):
     args = utils.m2list(args)
     if args:
-        sonic_pi_users[msg.nick] = [" ".join(args)]
+        pi_sessions.start(msg.nick, [" ".join(args)])
 
-    if msg.nick in sonic_pi_users:
-        # append to history
-        if msg.nick in sonic_pi_history:
-            sonic_pi_history[msg.nick].extend(sonic_pi_users[msg.nick])
-        else:
-            sonic_pi_history[msg.nick] = sonic_pi_users[msg.nick]
-
-        # Apply template
-        for i, line in enumerate(deepcopy(sonic_pi_users[msg.nick])):
-            for match in re.findall(r"\$\{([^}]+?)\}", line):
-                try:
-                    replace = convert(*match.split(" "))
-                    sonic_pi_users[msg.nick][i] = sonic_pi_users[msg.nick][i].replace(
-                        "${" + match + "}", replace)
-                    logger.debug(
-                        f"Applying template at {i=} {line=} {match=}, {replace=} {sonic_pi_users[msg.nick][i]=}")
-                except NoteNotFound as e:
-                    await reply(bot, msg, error(f"Could not find note '{e}'"))
-                    del sonic_pi_users[msg.nick]
-                    return
+    if pi_sessions.is_live(msg.nick):
+        lines = pi_sessions.finish(msg.nick)
+        try:
+            code = Template("\n".join(lines)).render()
+        except UnknownNotes as e:
+            await reply(bot, msg, error(f"Could not find notes: {e}"))
+            return
 
         await reply(bot, msg, "Your Sonic Pi repl is now off. Sending code to sonic pi...")
-        server.run_code("\n".join(sonic_pi_users[msg.nick]))
-        del sonic_pi_users[msg.nick]
+        await submit_pi_code(bot, msg, code)
         return
 
-    sonic_pi_users[msg.nick] = []
+    pi_sessions.start(msg.nick)
     await reply(bot, msg, f"Your Sonic Pi repl is now live at: {SONIC_PI_LIVE_URL}. Type {PREFIX}pi to turn it off and evaluate your code.")
 
 
@@ -345,28 +408,45 @@ async def cmd_convert(bot: IrcBot, args: re.Match, msg: Message):
         await reply(bot, msg, error(f"Could not find note for '{e}'"))
 
 
-@auth_command("pstop", "Stops sonic pi audio")
+@auth_command("pstop", "Stops your sonic pi code", f"{PREFIX}pstop [all] - Only admins can stop everyone's code")
 async def stop(bot: IrcBot, args: re.Match, msg: Message):
-    server.stop_all_jobs()
-    await reply(bot, msg, "Stopping audio...")
+    if args[1] == "all":
+        if msg.nick not in ADMINS:
+            await reply(bot, msg, error("Only admins can stop everyone's code"))
+            return
+        pi_scheduler.stop_all()
+        await reply(bot, msg, "Stopping audio...")
+        return
+    if not pi_scheduler.stop(msg.nick):
+        await reply(bot, msg, error("You have no sonic pi code running"))
+        return
+    await reply(bot, msg, "Stopping your code...")
 
 
 @auth_command("paste", "Pastes your sonic pi code and clears your history")
 async def pipaste(bot: IrcBot, args: re.Match, msg: Message):
-    if msg.nick not in sonic_pi_history:
+    history = pi_sessions.history(msg.nick)
+    if not history:
         await reply(bot, msg, error("You need to turn on your sonic pi repl first. Use {}pi".format(PREFIX)))
         return
-    await reply(bot, msg, paste("\n".join(sonic_pi_history[msg.nick])))
-    del sonic_pi_history[msg.nick]
+    try:
+        url = await paster.paste("\n".join(history))
+    except HTTPError as e:
+        await reply(bot, msg, error("Failed to paste: ") + str(e))
+        return
+    await reply(bot, msg, url)
+    pi_sessions.clear_history(msg.nick)
 
 
 @auth_command("read", "Read code from ix.io paste (or any raw text url)")
 async def readurl(bot: IrcBot, args: re.Match, msg: Message):
     try:
-        server.run_code(read_paste(args[1]))
-    except Exception as e:
+        code = await get_text(args[1], MAX_READ_SIZE)
+    except HTTPError as e:
         await reply(bot, msg, error("Failed to read paste: ") + str(e))
-    await reply(bot, msg, "Code has been read and sent!")
+        return
+    if await submit_pi_code(bot, msg, code):
+        await reply(bot, msg, "Code has been read and queued!")
 
 
 @utils.arg_command("source", "Shows bot source code url")
@@ -374,6 +454,15 @@ async def source(bot: IrcBot, args: re.Match, msg: Message):
     await reply(bot, msg, "https://github.com/matheusfillipe/mpd_irc_bot")
 
 
+@admin_command("stats", "(ADMIN) Latency percentiles of the bot's slow paths")
+async def stats(bot: IrcBot, args: re.Match, msg: Message):
+    lines = registry.summary()
+    if not lines:
+        await reply(bot, msg, "Nothing was measured yet")
+        return
+    await reply(bot, msg, lines, bulk=True)
+
+
 @admin_command("keep", "(ADMIN) keeps the music another use added", f"(ADMIN) {PREFIX}keep <nick|pos> You can either specify a position of an individual song or a nick to keep all from")
 async def keep(bot: IrcBot, args: re.Match, msg: Message):
     args = utils.m2list(args)
@@ -384,22 +473,24 @@ async def keep(bot: IrcBot, args: re.Match, msg: Message):
     nick_or_pos = args[0]
     if nick_or_pos.isdigit():
         pos = int(nick_or_pos)
-        if pos < 0 or pos >= len(song_queue.queue):
+        if pos >= await mpd_async.length():
             await reply(bot, msg, error("That is not a valid position"))
             return
         try:
-            song_queue.keep_song(pos)
+            song = await trio.to_thread.run_sync(song_queue.keep_song, pos)
         except SongQueue.PositionNotFoundError:
             await reply(bot, msg, error("That is not a valid position that was added by a user so it wont be deleted."))
             return
-        return
+        library.keep(library_path(song.uri))
 
     else:
         try:
-            song_queue.keep_all(nick_or_pos)
+            songs = song_queue.keep_all(nick_or_pos)
         except KeyError:
             await reply(bot, msg, error("That user Did not add any songs"))
             return
+        for song in songs:
+            library.keep(library_path(song.uri))
 
     await reply(bot, msg, "song(s) have been kept")
 
@@ -407,7 +498,7 @@ async def keep(bot: IrcBot, args: re.Match, msg: Message):
 @admin_command("next", "(ADMIN) Skips to next song in the playlist")
 async def next(bot: IrcBot, args: re.Match, msg: Message):
     try:
-        mpd_client.next()
+        await mpd_async.next()
     except Exception:
         await reply(bot, msg, error("Could not go to next song"))
 
@@ -415,7 +506,7 @@ async def next(bot: IrcBot, args: re.Match, msg: Message):
 @admin_command("prev", "(ADMIN) Goes back to previous song in the playlist")
 async def previous(bot: IrcBot, args: re.Match, msg: Message):
     try:
-        mpd_client.previous()
+        await mpd_async.previous()
     except Exception:
         await reply(bot, msg, error("Could not go back to previous song"))
 
@@ -426,7 +517,7 @@ async def play(bot: IrcBot, args: re.Match, msg: Message):
         await reply(bot, msg, error("You need to specify a position"))
         return
     try:
-        mpd_client.play(args[1])
+        await mpd_async.play(args[1])
     except Exception:
         await reply(bot, msg, error("Could not play song"))
 
@@ -437,7 +528,7 @@ async def delete(bot: IrcBot, args: re.Match, msg: Message):
         await reply(bot, msg, "You need to specify a position")
         return
     try:
-        mpd_client.delete(args[1])
+        await mpd_async.delete(args[1])
         await reply(bot, msg, "Song deleted successfully")
     except Exception:
         await reply(bot, msg, error("Failed to delete song"))
@@ -449,28 +540,28 @@ async def move(bot: IrcBot, args: re.Match, msg: Message):
         await reply(bot, msg, "You need to specify a from position and a to position")
         return
     try:
-        mpd_client.move(args[1], args[2])
+        await mpd_async.move(args[1], args[2])
         await reply(bot, msg, "Moved song successfully")
     except Exception:
         await reply(bot, msg, error("Failed to move!"))
 
 
 @utils.custom_handler("dccsend")
-async def on_dcc_send(bot: IrcBot, **m):
+async def on_dcc_send(bot: AccountBot, **m):
     nick = m["nick"]
-    if not await is_identified(bot, nick):
+    if not await bot.is_identified(nick):
         await bot.dcc_reject(DccServer.SEND, nick, m["filename"])
-        await bot.send_message(
+        output.send(
+            nick,
             error("You cannot use this bot before you register your nick"),
-            nick
         )
         return
 
-    if not song_queue.can_add(nick):
+    if not song_queue.can_add(nick, len(download_queue.user_jobs(nick))):
         await bot.dcc_reject(DccServer.SEND, nick, m["filename"])
-        await bot.send_message(
-            f"You cannot add more than {MAX_USER_QUEUE_LENGTH} audios. Wait for one of your songs to finish and try again.",
+        output.send(
             nick,
+            f"You cannot add more than {MAX_USER_QUEUE_LENGTH} audios. Wait for one of your songs to finish and try again.",
         )
         return
 
@@ -483,20 +574,20 @@ async def on_dcc_send(bot: IrcBot, **m):
     async def progress_handler(p, message):
         percentile = int(p * 100)
         if percentile % notify_each_b == 0:
-            await bot.send_message(message % percentile, m["nick"])
+            output.send(m["nick"], message % percentile, BULK)
 
     if int(m["size"]) > MAX_FILE_SIZE:
-        await bot.send_message(
-            error(
-                f"File too big! Max file size is {MAX_FILE_SIZE} bytes"), m["nick"]
+        output.send(
+            m["nick"],
+            error(f"File too big! Max file size is {MAX_FILE_SIZE} bytes"),
         )
         await bot.dcc_reject(DccServer.SEND, nick, m["filename"])
         return
 
     if not allowed_file(m["filename"]):
-        await bot.send_message(
-            error("File extension not allowed!"),
+        output.send(
             m["nick"],
+            error("File extension not allowed!"),
         )
         await bot.dcc_reject(DccServer.SEND, nick, m["filename"])
         return
@@ -505,32 +596,49 @@ async def on_dcc_send(bot: IrcBot, **m):
     to_dir = Path(MPD_FOLDER).expanduser() / Path(NICK)
     if not to_dir.exists():
         to_dir.mkdir(parents=True)
-    path = to_dir / Path(slugify(file.stem) + file.suffix)
-    if not await bot.dcc_get(
+    # Received under a hidden name and moved into the library once checked
+    path = to_dir / Path(f".{slugify(file.stem)}{file.suffix}.part")
+    with dcc_seconds.time(outcome="ok") as labels:
+        received = await bot.dcc_get(
             str(path),
             m,
             progress_callback=lambda _, p: progress_handler(
                 p, f"UPLOAD {Path(m['filename']).name} %s%%"
-            ),):
-        await bot.send_message(
-            error("Failed to download file"), m["nick"]
+            ),)
+        if not received:
+            labels["outcome"] = "failed"
+    if not received:
+        output.send(
+            m["nick"], error("Failed to download file")
         )
         return
+    dcc_bytes.inc(int(m["size"]))
 
-    await bot.send_message(
-        Message(
-            m["nick"], message=f"{m['filename']} has been received!", is_private=True
-        )
-    )
+    output.send(m["nick"], f"{m['filename']} has been received!")
 
     def on_add():
-        uri = os.path.join(NICK, path.name)
-        if get_audio_length(str(path)) > MAX_AUDIO_LENGTH:
+        if current_job().cancelled.is_set():
             os.remove(str(path))
-            sync_write_fifo(
-                f"[[{m['nick']}]] Your audio is too lenghty. Max allowed is: {MAX_AUDIO_LENGTH} seconds.")
+            return
+        try:
+            length = get_audio_length(str(path))
+        except ProbeError:
+            os.remove(str(path))
+            relay.post(
+                m['nick'], error("Could not read the audio file you sent."))
+            return
+        if length > MAX_AUDIO_LENGTH:
+            os.remove(str(path))
+            relay.post(
+                m['nick'], f"Your audio is too lenghty. Max allowed is: {MAX_AUDIO_LENGTH} seconds.")
+            return
+        try:
+            song = move_file(str(path), file.stem, str(to_dir), file.suffix)
+        except FailedToProcess:
+            relay.post(m['nick'], error("Sorry but an error occurred."))
             return
 
+        uri = os.path.join(NICK, Path(song).name)
         mpd_client.add_next(uri)
         onend_text = f"{m['filename']} has been added to the playlist!"
         if m['nick'] in ADMINS:
@@ -548,17 +656,25 @@ async def on_dcc_send(bot: IrcBot, **m):
                     "Sorry but your queue is full. Wait until one of your songs finishes and try adding again.")
             except Exception:
                 onend_text = error("Sorry but an error occurred.")
-        sync_write_fifo(
-            f"[[{m['nick']}]] {onend_text}")
+        relay.post(m['nick'], onend_text)
+        enforce_quota()
+
+    def on_timeout(job: Job):
+        relay.post(nick, error(f"Processing {m['filename']} took too long and was cancelled"))
 
     try:
-        thread_pool.add_task(on_add)
-    except ThreadPool.FullError:
-        await bot.send_message(
-            error("The bot is currently busy downloading other songs. Try again soon."),
+        job = download_queue.submit(nick, on_add, on_timeout=on_timeout)
+    except JobQueue.FullError:
+        os.remove(str(path))
+        output.send(
             nick,
+            error("The download queue is full. Try again soon."),
         )
         return
+    position = download_queue.position(job)
+    if position:
+        output.send(
+            nick, f"{m['filename']} is queued at position {position}")
 
 
 @utils.custom_handler("dccreject")
@@ -568,38 +684,64 @@ def on_dcc_reject(**m):
 
 @utils.regex_cmd_with_messsage(r"^(.+)$")
 def all_msgs(args: re.Match, msg: Message):
-    if msg.nick not in sonic_pi_users or msg.message.strip().startswith(PREFIX):
+    if not pi_sessions.is_live(msg.nick) or msg.message.strip().startswith(PREFIX):
         return
-    sonic_pi_users[msg.nick].append(args[1])
+    session = pi_sessions.add_line(msg.nick, args[1])
+    if session.dropped == 1:
+        output.send(msg.channel, _reply_str(None, msg, error(
+            f"Your code is too long, further lines are ignored. Type {PREFIX}pi to evaluate it.")))
 
 
 async def onconnect(bot: IrcBot):
+    async def send_relayed(channel, text):
+        for channel in CHANNELS if channel is None else [channel]:
+            logging.debug(
+                f" Message relay handler: {channel=}, {text=}")
+            output.send(channel, text)
+
     async def message_handler(text):
+        """Lines written to the relay fifo by external scripts."""
         match = re.match(r"^\[\[([^\]]+)\]\] (.*)$", text)
         if match:
-            channel, text = match.groups()
-            logging.debug(
-                f" Message relay server handler regex: {channel=}, {text=}")
-            await bot.send_message(text, channel)
+            await send_relayed(*match.groups())
             return
-        for channel in CHANNELS:
-            logging.debug(
-                f" Message relay server handler simple: {channel=}, {text=}")
-            await bot.send_message(text, channel)
+        await send_relayed(None, text)
+
+    async def send_pi_error(target, nick, text):
+        output.send(target, error(text), prefix=f"{Color('(' + nick + '):', fg=Color.green).str} ")
 
     async def mpd_player_handler():
         logger.debug("MPD UPDATE")
         try:
             timestamp = datetime.datetime.utcnow().strftime('%Y-%m-%d %H:%M:%S')
-            song_queue.update()
-            await message_handler(f"[{Color(timestamp, fg=Color.orange).str} UTC] - Playing: {mpd_client.current_song_name()}")
+            await trio.to_thread.run_sync(on_player_event)
+            await send_relayed(None, f"[{Color(timestamp, fg=Color.orange).str} UTC] - Playing: {await mpd_async.current_song_name()}")
         except Exception as e:
             logger.error(f"MPD UPDATE ERROR: {e=}")
 
+    async def mpd_playlist_handler():
+        try:
+            await mpd_async.sync_playlist()
+        except Exception as e:
+            logger.error(f"MPD PLAYLIST SYNC ERROR: {e=}")
+
+    await bot.request_capabilities()
     async with trio.open_nursery() as nursery:
-        nursery.start_soon(
-            listen_loop, MESSAGE_RELAY_FIFO_PATH, message_handler)
-        nursery.start_soon(mpd_loop_with_handler, mpd_player_handler)
+        await nursery.start(output.run, bot)
+        await nursery.start(relay.run, send_relayed)
+        if MESSAGE_RELAY_FIFO_PATH:
+            nursery.start_soon(
+                listen_loop, MESSAGE_RELAY_FIFO_PATH, message_handler)
+        if pi_logs:
+            await nursery.start(pi_logs.run, send_pi_error)
+        await nursery.start(pi_scheduler.run, send_pi_error)
+        if METRICS_HTTP_PORT:
+            await nursery.start(serve_metrics, METRICS_HTTP_PORT, METRICS_HOST)
+        nursery.start_soon(mpd_client.events.run)
+        nursery.start_soon(mpd_loop_with_handler,
+                           mpd_player_handler, "player", mpd_client)
+        nursery.start_soon(mpd_loop_with_handler,
+                           mpd_playlist_handler, "playlist", mpd_client)
 
 utils.setHelpHeader(Color("RADIO BOT COMMANDS", fg=Color.cyan).str)
 utils.setHelpBottom(
@@ -607,6 +749,6 @@ utils.setHelpBottom(
 
 if __name__ == "__main__":
     utils.setLogging(LOG_LEVEL, LOGFILE)
-    bot = IrcBot(HOST, PORT, NICK, CHANNELS, PASSWORD, use_ssl=PORT == 6697,
-                 dcc_host=DCC_HOST, dcc_ports=DCC_PORTS, dcc_announce_host=DCC_ANNOUNCE_HOST)
+    bot = AccountBot(HOST, PORT, NICK, CHANNELS, PASSWORD, use_ssl=PORT == 6697,
+                     dcc_host=DCC_HOST, dcc_ports=DCC_PORTS, dcc_announce_host=DCC_ANNOUNCE_HOST)
     bot.runWithCallback(onconnect)
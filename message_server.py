@@ -12,13 +12,55 @@
 
 
 import asyncio
+import logging
 import os
 import stat
-from typing import Callable
+from typing import Callable, Optional
 
 import trio
 
 BUFFER_SIZE = 1024
+# Messages waiting to be sent before posting threads block
+RELAY_BUFFER = 256
+
+logger = logging.getLogger()
+
+
+class Relay:
+    """Delivers messages posted from worker threads to a handler running on
+    the trio loop.
+
+    Messages are ``(channel, text)`` pairs, channel being None for a
+    broadcast.
+    """
+
+    class NotRunningError(Exception):
+        pass
+
+    def __init__(self, buffer: int = RELAY_BUFFER):
+        self.send_channel, self.receive_channel = trio.open_memory_channel(buffer)
+        self.token: Optional[trio.lowlevel.TrioToken] = None
+
+    def post(self, channel: Optional[str], text: str):
+        """Queue a message from a thread other than the trio one. Blocks only
+        while the buffer is full.
+
+        Can raise NotRunningError.
+        """
+        if self.token is None:
+            raise Relay.NotRunningError()
+        trio.from_thread.run(
+            self.send_channel.send, (channel, text), trio_token=self.token)
+
+    async def run(self, handler: Callable, task_status=trio.TASK_STATUS_IGNORED):
+        """Call handler(channel, text) for every posted message."""
+        self.token = trio.lowlevel.current_trio_token()
+        task_status.started()
+        async for channel, text in self.receive_channel:
+            try:
+                await handler(channel, text)
+            except Exception as e:
+                logger.error(f"Relay handler failed for {channel=}: {e}")
 
 
 async def listen_loop(fifo_path: str, handler: Callable):
@@ -0,0 +1,242 @@
+################################################################################
+#      ____  ___    ____  ________     ____  ____  ______
+#     / __ \/   |  / __ \/  _/ __ \   / __ )/ __ \/_  __/
+#    / /_/ / /| | / / / // // / / /  / __  / / / / / /
+#   / _, _/ ___ |/ /_/ // // /_/ /  / /_/ / /_/ / / /
+#  /_/ |_/_/  |_/_____/___/\____/  /_____/\____/ /_/
+#
+#
+# Matheus Fillipe 18/05/2022
+# MIT License
+################################################################################
+
+
+import bisect
+import functools
+import logging
+import math
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+from typing import Callable, Deque, Dict, List, Optional, Tuple
+
+import trio
+
+METRICS_ADDRESS = "127.0.0.1"
+METRICS_PORT = 9417
+# Upper bounds in seconds of the histogram buckets
+BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600)
+# Latest observations kept per label set to compute percentiles from
+SAMPLE_SIZE = 1024
+QUANTILES = (0.5, 0.95, 0.99)
+MAX_REQUEST_SIZE = 8192
+
+logger = logging.getLogger()
+
+Labels = Tuple[Tuple[str, str], ...]
+
+
+def _labels(labels: dict) -> Labels:
+    return tuple(sorted((k, str(v)) for k, v in labels.items()))
+
+
+def format_labels(labels: Labels, extra: str = "") -> str:
+    pairs = [f'{k}="{v}"' for k, v in labels]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+def quantile(samples: List[float], q: float) -> float:
+    """Nearest rank quantile of sorted samples."""
+    return samples[max(0, math.ceil(q * len(samples)) - 1)]
+
+
+class Counter:
+    def __init__(self, name: str, help: str):
+        self.name = name
+        self.help = help
+        self.values: Dict[Labels, float] = {}
+        self.lock = threading.Lock()
+
+    def inc(self, amount: float = 1, **labels):
+        key = _labels(labels)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+    def render(self) -> List[str]:
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} counter"]
+        with self.lock:
+            for labels, value in sorted(self.values.items()):
+                lines.append(f"{self.name}{format_labels(labels)} {value}")
+        return lines
+
+
+class Histogram:
+    """Latencies in seconds, bucketed for prometheus and sampled for
+    percentiles."""
+
+    class Series:
+        def __init__(self):
+            self.buckets = [0] * (len(BUCKETS) + 1)
+            self.sum = 0.0
+            self.count = 0
+            self.samples: Deque[float] = deque(maxlen=SAMPLE_SIZE)
+
+    def __init__(self, name: str, help: str):
+        self.name = name
+        self.help = help
+        self.series: Dict[Labels, Histogram.Series] = {}
+        self.lock = threading.Lock()
+
+    def observe(self, value: float, **labels):
+        key = _labels(labels)
+        with self.lock:
+            series = self.series.get(key)
+            if series is None:
+                series = self.series[key] = Histogram.Series()
+            series.buckets[bisect.bisect_left(BUCKETS, value)] += 1
+            series.sum += value
+            series.count += 1
+            series.samples.append(value)
+
+    @contextmanager
+    def time(self, **labels):
+        """Observe how long the block takes. Labels can still be changed
+        from inside it through the yielded dict."""
+        labels = dict(labels)
+        start = time.perf_counter()
+        try:
+            yield labels
+        finally:
+            self.observe(time.perf_counter() - start, **labels)
+
+    def quantiles(self) -> Dict[Labels, Tuple[int, List[float]]]:
+        """Observation count and QUANTILES of the recent samples of each
+        label set."""
+        with self.lock:
+            snapshot = {labels: (series.count, sorted(series.samples))
+                        for labels, series in self.series.items()}
+        return {labels: (count, [quantile(samples, q) for q in QUANTILES])
+                for labels, (count, samples) in snapshot.items() if samples}
+
+    def render(self) -> List[str]:
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} histogram"]
+        with self.lock:
+            for labels, series in sorted(self.series.items()):
+                cumulative = 0
+                for bound, count in zip(BUCKETS + (math.inf,), series.buckets):
+                    cumulative += count
+                    le = "+Inf" if bound == math.inf else repr(float(bound))
+                    bucket_labels = format_labels(labels, 'le="' + le + '"')
+                    lines.append(f"{self.name}_bucket{bucket_labels} {cumulative}")
+                lines.append(f"{self.name}_sum{format_labels(labels)} {series.sum}")
+                lines.append(f"{self.name}_count{format_labels(labels)} {series.count}")
+        return lines
+
+
+class Registry:
+    def __init__(self):
+        self.metrics: Dict[str, object] = {}
+        self.lock = threading.Lock()
+
+    def _get(self, cls, name: str, help: str):
+        with self.lock:
+            if name not in self.metrics:
+                self.metrics[name] = cls(name, help)
+            return self.metrics[name]
+
+    def counter(self, name: str, help: str) -> Counter:
+        return self._get(Counter, name, help)
+
+    def histogram(self, name: str, help: str) -> Histogram:
+        return self._get(Histogram, name, help)
+
+    def histograms(self) -> List[Histogram]:
+        with self.lock:
+            return [m for m in self.metrics.values() if isinstance(m, Histogram)]
+
+    def render(self) -> str:
+        """Every metric in the prometheus text format."""
+        with self.lock:
+            metrics = list(self.metrics.values())
+        return "\n".join(line for metric in metrics for line in metric.render()) + "\n"
+
+    def summary(self) -> List[str]:
+        """One line with the percentiles of each label set of every
+        histogram."""
+        lines = []
+        for histogram in self.histograms():
+            for labels, (count, values) in sorted(histogram.quantiles().items()):
+                percentiles = " ".join(f"p{round(q * 100)}={format_duration(v)}"
+                                       for q, v in zip(QUANTILES, values))
+                lines.append(f"{histogram.name}{format_labels(labels)} n={count} {percentiles}")
+        return lines
+
+
+registry = Registry()
+
+
+def format_duration(seconds: float) -> str:
+    if seconds < 1:
+        return f"{seconds * 1000:.1f}ms"
+    return f"{seconds:.2f}s"
+
+
+def timed(histogram: Histogram, errors: Optional[Counter] = None, **labels) -> Callable:
+    """Decorator observing how long each call takes, labelled by function
+    name when no labels are given. Exceptions are counted in errors."""
+    def decorator(func):
+        call_labels = labels or {"call": func.__name__}
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            with histogram.time(**call_labels):
+                try:
+                    return func(*args, **kwargs)
+                except Exception:
+                    if errors is not None:
+                        errors.inc(**call_labels)
+                    raise
+        return wrapper
+    return decorator
+
+
+async def _handle(stream: trio.SocketStream):
+    try:
+        with trio.move_on_after(5):
+            request = b""
+            while b"\r\n\r\n" not in request and len(request) < MAX_REQUEST_SIZE:
+                data = await stream.receive_some(MAX_REQUEST_SIZE)
+                if not data:
+                    break
+                request += data
+            path = request.split(b" ")[1] if request.count(b" ") >= 2 else b""
+            if path.split(b"?")[0] == b"/metrics":
+                status, body = "200 OK", registry.render().encode()
+            else:
+                status, body = "404 Not Found", b"Not found\n"
+            await stream.send_all(
+                f"HTTP/1.0 {status}\r\n"
+                "Content-Type: text/plain; version=0.0.4; charset=utf-8\r\n"
+                f"Content-Length: {len(body)}\r\n"
+                "Connection: close\r\n\r\n".encode() + body)
+    except (OSError, trio.BrokenResourceError) as e:
+        logger.debug(f"Metrics request failed: {e}")
+    finally:
+        await trio.aclose_forcefully(stream)
+
+
+async def serve(port: int = METRICS_PORT, address: str = METRICS_ADDRESS,
+                task_status=trio.TASK_STATUS_IGNORED):
+    """Serve the metrics at http://address:port/metrics."""
+    try:
+        listeners = await trio.open_tcp_listeners(port, host=address)
+    except OSError as e:
+        logger.error(f"Can't serve metrics on {address}:{port}: {e}")
+        task_status.started()
+        return
+    logger.info(f"Serving metrics on http://{address}:{port}/metrics")
+    task_status.started()
+    await trio.serve_listeners(_handle, listeners)
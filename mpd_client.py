@@ -13,35 +13,437 @@
 
 import asyncio
 import datetime
+import functools
 import logging
+import re
+import threading
 import time
+from contextlib import contextmanager
 from pathlib import Path
-from typing import Callable
+from typing import Callable, Dict, Generator, List, Optional, Tuple
 
 import mpd
 import trio
 from mpd import MPDClient as Client
 
+from metrics import registry, timed
+
 NEXT_LIST_LENGTH = 5
 ADD_RETRY_DELAY = 5
+UPDATE_POLL_INTERVAL = 0.1
+POOL_SIZE = 4
+CONNECT_TIMEOUT = 10
+# Idle connections older than this are pinged before being handed out
+HEALTH_CHECK_INTERVAL = 30
+MIN_BACKOFF = 0.5
+MAX_BACKOFF = 30
+# Seconds a single command of the async client may take
+COMMAND_TIMEOUT = 10
+IDLE_SUBSYSTEMS = ["player", "playlist", "database", "options"]
+# Pending events per subscriber before new ones are dropped
+SUBSCRIBER_BUFFER = 16
+# Incremental playlist syncs tried before falling back to a full reload
+SYNC_ATTEMPTS = 3
+# mpd's ACK_ERROR_NO_EXIST
+ACK_NO_EXIST = 50
+# "[error@command_listNum]" at the start of an ACK
+ACK_RE = re.compile(r"\[(\d+)@(\d+)\]")
 
 logger = logging.getLogger()
+mpd_seconds = registry.histogram("mpdbot_mpd_call_seconds", "Latency of MPD client calls")
+mpd_errors = registry.counter("mpdbot_mpd_call_errors_total", "MPD client calls that failed")
+
+
+class ConnectionPool:
+    """Persistent mpd connections shared by the worker threads and the trio
+    loop.
+
+    Each connection has its own lock so only one caller talks to it at a
+    time. Connections that sat idle for a while are pinged before being
+    reused, broken ones are dropped and reconnected on the next lease,
+    backing off exponentially while mpd is unreachable.
+    """
+
+    class Connection:
+        def __init__(self):
+            self.client: Client = None
+            self.lock = threading.Lock()
+            self.last_used = 0.0
+
+    def __init__(self, host: str, port: int, size: int = POOL_SIZE, timeout: float = CONNECT_TIMEOUT):
+        self.host = host
+        self.port = port
+        self.timeout = timeout
+        self.connections = [ConnectionPool.Connection() for _ in range(size)]
+        self.available = threading.Semaphore(size)
+        self._local = threading.local()
+        self._backoff_lock = threading.Lock()
+        self._backoff = MIN_BACKOFF
+        self._retry_at = 0.0
+
+    def _take_free(self) -> "ConnectionPool.Connection":
+        # Prefer already connected clients so we don't open new sockets
+        for conn in sorted(self.connections, key=lambda c: c.client is None):
+            if conn.lock.acquire(blocking=False):
+                return conn
+        raise RuntimeError("Connection pool semaphore out of sync")
+
+    def _drop(self, conn: "ConnectionPool.Connection"):
+        try:
+            conn.client.disconnect()
+        except Exception:
+            pass
+        conn.client = None
+
+    def _connect(self, conn: "ConnectionPool.Connection"):
+        with self._backoff_lock:
+            wait = self._retry_at - time.monotonic()
+        if wait > 0:
+            raise mpd.ConnectionError(
+                f"mpd at {self.host}:{self.port} is unreachable, retrying in {wait:.1f}s")
+        client = Client()
+        client.timeout = self.timeout
+        try:
+            client.connect(self.host, self.port)
+        except (mpd.ConnectionError, OSError) as e:
+            with self._backoff_lock:
+                self._retry_at = time.monotonic() + self._backoff
+                self._backoff = min(self._backoff * 2, MAX_BACKOFF)
+            logger.error(f"Failed to connect to mpd: {e}")
+            raise mpd.ConnectionError(str(e)) from e
+        with self._backoff_lock:
+            self._backoff = MIN_BACKOFF
+            self._retry_at = 0.0
+        logger.debug(f"Opened mpd connection to {self.host}:{self.port}")
+        conn.client = client
+
+    def _ensure_connected(self, conn: "ConnectionPool.Connection"):
+        if conn.client is not None and time.monotonic() - conn.last_used > HEALTH_CHECK_INTERVAL:
+            try:
+                conn.client.ping()
+            except (mpd.ConnectionError, OSError):
+                logger.info("Dropping stale mpd connection")
+                self._drop(conn)
+        if conn.client is None:
+            self._connect(conn)
+
+    @contextmanager
+    def lease(self):
+        """Borrow a connected client for the current thread.
+
+        Nested leases on the same thread reuse the outer connection.
+        """
+        conn = getattr(self._local, "conn", None)
+        if conn is not None:
+            yield conn.client
+            return
+        with self.available:
+            conn = self._take_free()
+            try:
+                self._ensure_connected(conn)
+                self._local.conn = conn
+                try:
+                    yield conn.client
+                except (mpd.ConnectionError, mpd.ProtocolError, OSError):
+                    self._drop(conn)
+                    raise
+                finally:
+                    self._local.conn = None
+                    conn.last_used = time.monotonic()
+            finally:
+                conn.lock.release()
+
+    def leased(self) -> bool:
+        """Whether the current thread already holds a lease."""
+        return getattr(self._local, "conn", None) is not None
+
+    def discard_current(self):
+        """Drop the connection leased to the current thread so it is
+        reopened on the next lease."""
+        conn = getattr(self._local, "conn", None)
+        if conn is not None and conn.client is not None:
+            self._drop(conn)
+
+    def current(self) -> Client:
+        """Client leased to the current thread."""
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            raise RuntimeError("No mpd connection leased on this thread")
+        return conn.client
+
+    def close(self):
+        """Disconnect every idle connection."""
+        for conn in self.connections:
+            with conn.lock:
+                if conn.client is not None:
+                    self._drop(conn)
+
+
+class PlaylistMirror:
+    """In-process copy of mpd's queue keyed by the playlist version.
+
+    It is brought up to date with the songs ``plchangesposid`` reports as
+    changed since the mirrored version, so reading the queue never needs
+    a full ``playlistinfo`` transfer. Also keeps an id -> position index.
+    """
+
+    def __init__(self):
+        self.version: Optional[int] = None
+        self.songs: List[dict] = []
+        self.positions: Dict[str, int] = {}
+        self.lock = threading.RLock()
+        self._formatted: Optional[Tuple[int, List[str], int]] = None
+
+    def __len__(self) -> int:
+        return len(self.songs)
+
+    def reset(self, version: int, songs: List[dict]):
+        """Replace the mirror with a full playlistinfo result."""
+        with self.lock:
+            self.songs = list(songs)
+            self.positions = {song["id"]: pos for pos, song in enumerate(self.songs)}
+            self.version = version
+
+    def apply(self, version: int, length: int, changes: List[Tuple[int, dict]]):
+        """Apply the (position, song) pairs that changed since our version,
+        ordered by position, to reach the playlist version with length
+        songs."""
+        with self.lock:
+            for pos in range(length, len(self.songs)):
+                self._unindex(pos)
+            del self.songs[length:]
+            for pos, song in changes:
+                song = dict(song, pos=str(pos))
+                if pos < len(self.songs):
+                    self._unindex(pos)
+                    self.songs[pos] = song
+                elif pos == len(self.songs):
+                    self.songs.append(song)
+                else:
+                    raise ValueError(f"Playlist changes skip position {pos}")
+                self.positions[song["id"]] = pos
+            self.version = version
+
+    def missing(self, changes: List[dict]) -> List[str]:
+        """Ids from plchangesposid output that the mirror never saw."""
+        return [c["id"] for c in changes if self.position_of(c["id"]) is None]
+
+    def update(self, base: int, status: dict, changes: List[dict], fetched: List[List[dict]]) -> bool:
+        """Apply plchangesposid output computed against the base version.
+
+        fetched holds the playlistid results for the ``missing`` ids.
+        Returns False, leaving the mirror untouched, if it moved away from
+        base in the meantime.
+        """
+        with self.lock:
+            if self.version != base:
+                return False
+            new_songs = {songs[0]["id"]: songs[0] for songs in fetched}
+            self.apply(
+                int(status["playlist"]),
+                int(status["playlistlength"]),
+                [(int(c["cpos"]), new_songs.get(c["id"]) or self.song(c["id"]))
+                 for c in changes])
+            return True
+
+    def _unindex(self, pos: int):
+        id = self.songs[pos]["id"]
+        # The song might have already been reindexed at its new position
+        if self.positions.get(id) == pos:
+            del self.positions[id]
+
+    def song(self, id: str) -> Optional[dict]:
+        with self.lock:
+            pos = self.positions.get(id)
+            return None if pos is None else self.songs[pos]
+
+    def position_of(self, id: str) -> Optional[int]:
+        return self.positions.get(id)
+
+    def song_at(self, pos: int) -> dict:
+        with self.lock:
+            return self.songs[pos]
+
+    def slice(self, start: int = 0, end: int = None) -> List[dict]:
+        with self.lock:
+            return self.songs[start:end]
+
+    def formatted(self) -> Tuple[int, List[str], int]:
+        """Version, every song formatted for display and the total duration
+        in seconds. Formatted once per playlist version, the list must not be
+        modified."""
+        with self.lock:
+            if self._formatted is None or self._formatted[0] != self.version:
+                self._formatted = (
+                    self.version,
+                    [format_song(song) for song in self.songs],
+                    int(sum(float(song.get("duration", 0)) for song in self.songs)))
+            return self._formatted
+
+
+def sync_steps(mirror: PlaylistMirror) -> Generator[tuple, list, dict]:
+    """Bring the mirror up to date, returning mpd's status.
+
+    Yields the commands of each command list to run and is sent back their
+    results, or thrown the CommandError, so the sync and async clients
+    share it. Costs a single round trip when the playlist did not change.
+    Only songs the mirror has never seen are fetched with playlistid, when
+    one was deleted meanwhile the changes are fetched again from the newer
+    version.
+    """
+    for _ in range(SYNC_ATTEMPTS):
+        base = mirror.version
+        if base is None:
+            break
+        status, changes = yield (("status", ), ("plchangesposid", base))
+        version = int(status["playlist"])
+        if version == base:
+            return status
+        # A lower version means mpd was restarted
+        if version < base:
+            break
+        missing = mirror.missing(changes)
+        try:
+            fetched = (yield tuple(("playlistid", id) for id in missing)) if missing else []
+        except mpd.CommandError as e:
+            match = ACK_RE.search(str(e))
+            if match and int(match[1]) == ACK_NO_EXIST:
+                logger.debug(f"Playlist changed while syncing it: {e}")
+                continue
+            logger.warning(f"Reloading the whole playlist: {e}")
+            break
+        try:
+            # Otherwise another caller moved the mirror meanwhile
+            if mirror.update(base, status, changes, fetched):
+                return status
+        except ValueError as e:
+            logger.warning(f"Reloading the whole playlist: {e}")
+            break
+    status, playlist = yield (("status", ), ("playlistinfo", ))
+    mirror.reset(int(status["playlist"]), playlist)
+    return status
+
+
+class LineReader:
+    """Frames newline terminated lines out of a trio stream, keeping
+    whatever partial line a read left behind for the next one."""
+
+    def __init__(self, stream: trio.abc.ReceiveStream):
+        self.stream = stream
+        self.buffer = bytearray()
+
+    async def readline(self) -> str:
+        """Return the next line without its newline. Raises
+        mpd.ConnectionError if the stream is closed."""
+        while True:
+            end = self.buffer.find(b"\n")
+            if end >= 0:
+                line = self.buffer[:end].decode()
+                del self.buffer[:end + 1]
+                return line
+            data = await self.stream.receive_some(4096)
+            if not data:
+                raise mpd.ConnectionError("Connection closed by mpd")
+            self.buffer += data
+
+
+class IdleListener:
+    """Long lived ``idle`` connection that fans mpd events out to every
+    subscriber.
+
+    A single connection watches all the subsystems and goes back to idle
+    right after each notification, so nothing that happens in between is
+    lost. It is reopened with exponential backoff when it drops, after
+    which every subsystem is announced once so subscribers can resync.
+    """
+
+    def __init__(self, host: str, port: int, subsystems: List[str] = IDLE_SUBSYSTEMS):
+        self.host = host
+        self.port = port
+        self.subsystems = list(subsystems)
+        self._subscribers = []
+
+    def subscribe(self, *subsystems: str) -> trio.MemoryReceiveChannel:
+        """Channel receiving the name of each changed subsystem. Defaults
+        to all the watched ones. Close it to unsubscribe."""
+        send, receive = trio.open_memory_channel(SUBSCRIBER_BUFFER)
+        self._subscribers.append((set(subsystems or self.subsystems), send))
+        return receive
+
+    def _publish(self, subsystem: str):
+        for subscriber in list(self._subscribers):
+            subsystems, channel = subscriber
+            if subsystem not in subsystems:
+                continue
+            try:
+                channel.send_nowait(subsystem)
+            except trio.WouldBlock:
+                logger.warning(f"Dropping mpd {subsystem} event for a slow subscriber")
+            except (trio.BrokenResourceError, trio.ClosedResourceError):
+                self._subscribers.remove(subscriber)
+
+    async def _listen(self, stream: trio.SocketStream, task_status):
+        lines = LineReader(stream)
+        greeting = await lines.readline()
+        if not greeting.startswith("OK MPD"):
+            raise mpd.ProtocolError(f"Unexpected greeting: {greeting}")
+        task_status.started()
+        command = f"idle {' '.join(self.subsystems)}\n".encode()
+        while True:
+            await stream.send_all(command)
+            while True:
+                line = await lines.readline()
+                if line == "OK":
+                    break
+                if line.startswith("ACK"):
+                    raise mpd.CommandError(line)
+                if line.startswith("changed: "):
+                    self._publish(line[len("changed: "):])
+
+    async def run(self, task_status=trio.TASK_STATUS_IGNORED):
+        """Listen forever. Use with ``nursery.start`` to wait for the
+        first connection."""
+        backoff = MIN_BACKOFF
+        connected_once = False
+        while True:
+            try:
+                async with await trio.open_tcp_stream(self.host, self.port) as stream:
+                    async with trio.open_nursery() as nursery:
+                        await nursery.start(self._listen, stream)
+                        backoff = MIN_BACKOFF
+                        if connected_once:
+                            for subsystem in self.subsystems:
+                                self._publish(subsystem)
+                        else:
+                            connected_once = True
+                            task_status.started()
+            except (OSError, trio.BrokenResourceError, mpd.MPDError) as e:
+                logger.warning(
+                    f"MPD idle connection lost: {e}. Reconnecting in {backoff}s")
+            await trio.sleep(backoff)
+            backoff = min(backoff * 2, MAX_BACKOFF)
 
 
 def dropin(func):
-    """Decorator that connects the client, executes the function and
-    disconnects the client."""
-    def wrapper(*args, **kwargs):
-        MPDClient.connect()
-        result = func(*args, **kwargs)
-        MPDClient.disconnect()
-        return result
+    """Decorator that leases a pooled connection for the duration of the
+    call. Only the outermost call is timed, nested ones reuse its lease."""
+    @timed(mpd_seconds, mpd_errors, client="pool", call=func.__name__)
+    def leased(self, *args, **kwargs):
+        with self.pool.lease():
+            return func(self, *args, **kwargs)
+
+    @functools.wraps(func)
+    def wrapper(self, *args, **kwargs):
+        if self.pool.leased():
+            return func(self, *args, **kwargs)
+        return leased(self, *args, **kwargs)
     return wrapper
 
 
 def int_args(func):
     """Decorator that converts all arguments to int."""
 
+    @functools.wraps(func)
     def wrapper(self, *args, **kwargs):
         return func(self, *[int(a) for a in args], **{k: int(v) for k, v in kwargs.items()})
     return wrapper
@@ -59,163 +461,502 @@ def format_dict(d: dict):
     return ", ".join(f"{k}: {format_data(d, k)}" for k in d)
 
 
-class MPDClient:
-    client: Client = None
-    _host: str = None
-    _port: int = None
+def format_song(song: dict):
+    include_keys = ["duration", "file", "pos"]
+    return format_dict({k: v for k, v in song.items() if k in include_keys})
+
+
+def format_current_song(status: dict, current: dict):
+    data = {}
+    filter_keys = ["state", "duration", "elapsed"]
+    data.update({k: v for k, v in status.items() if k in filter_keys})
+    include_keys = ["duration", "file", "pos"]
+    data.update({k: v for k, v in current.items() if k in include_keys})
+    return format_dict(data)
+
 
-    def __init__(self, host, port):
-        MPDClient._host = host
-        MPDClient._port = port
+def format_next_songs(mirror: PlaylistMirror, pos: int):
+    return [format_song(song)
+            for song in mirror.slice(pos, pos + NEXT_LIST_LENGTH) +
+            mirror.slice(0, NEXT_LIST_LENGTH)
+            ][:NEXT_LIST_LENGTH]
 
-    @classmethod
-    def connect(cls):
-        cls.client = Client()
-        cls.client.connect(cls._host, cls._port)
 
-    @classmethod
-    def disconnect(cls):
-        cls.client.close()
-        cls.client.disconnect()
+def format_playlist_footer(duration: int, length: int):
+    return [f"                      Total duration: {datetime.timedelta(seconds=duration)}",
+            f"                      Total songs: {length}"]
+
+
+def format_playlist(playlist: List[dict], length: int):
+    info = [format_song(song) for song in playlist]
+    duration = int(sum(float(song['duration']) for song in playlist))
+    return info + format_playlist_footer(duration, length)
+
+
+class MPDClient:
+    # One pool, playlist mirror and idle listener per server, shared by
+    # every instance talking to it
+    _pools = {}
+    _mirrors = {}
+    _listeners = {}
+
+    def __init__(self, host, port, pool_size: int = POOL_SIZE):
+        self._host = host
+        self._port = port
+        if (host, port) not in MPDClient._pools:
+            MPDClient._pools[(host, port)] = ConnectionPool(
+                host, port, pool_size)
+        self.pool = MPDClient._pools[(host, port)]
+        self.mirror = MPDClient._mirrors.setdefault(
+            (host, port), PlaylistMirror())
+        if (host, port) not in MPDClient._listeners:
+            MPDClient._listeners[(host, port)] = IdleListener(host, port)
+        self.events = MPDClient._listeners[(host, port)]
+
+    @property
+    def client(self) -> Client:
+        return self.pool.current()
 
     @dropin
     def cmd(self, cmd: str):
-        return getattr(MPDClient.client, cmd)()
+        return getattr(self.client, cmd)()
+
+    @dropin
+    def update(self, uri: str = "") -> str:
+        """Rescan uri in mpd's database, returning the update job id."""
+        return self.client.update(uri)
+
+    @dropin
+    def batch(self, *commands: tuple) -> list:
+        """Run several commands in a single command list round trip.
+
+        Each command is a tuple with the command name followed by its
+        arguments, e.g. ``("addid", uri, pos)``. Returns the result of each
+        command in order. Can raise CommandError, in which case mpd
+        stopped at the failing command.
+        """
+        client = self.client
+        client.command_list_ok_begin()
+        try:
+            for name, *args in commands:
+                getattr(client, name)(*args)
+        except Exception:
+            # Half written command list, this connection can't be trusted
+            self.pool.discard_current()
+            raise
+        return client.command_list_end()
 
     @dropin
     def current_song(self):
-        data = {}
-        filter_keys = ["state", "duration", "elapsed"]
-        data.update(
-            {k: v for k, v in MPDClient.client.status().items() if k in filter_keys})
-        include_keys = ["duration", "file", "pos"]
-        data.update(
-            {k: v for k, v in MPDClient.client.currentsong().items() if k in include_keys})
-        return ", ".join(f"{k}: {format_data(data, k)}" for k in data)
+        return format_current_song(self.client.status(), self.client.currentsong())
 
     @dropin
     def current_song_name(self):
-        return format_data(MPDClient.client.currentsong(), "file")
+        return format_data(self.client.currentsong(), "file")
+
+    @dropin
+    def sync_playlist(self) -> dict:
+        """Bring the playlist mirror up to date, returning mpd's status.
+
+        See sync_steps.
+        """
+        steps = sync_steps(self.mirror)
+        result, error = None, None
+        while True:
+            try:
+                commands = steps.throw(error) if error else steps.send(result)
+            except StopIteration as done:
+                return done.value
+            try:
+                result, error = self.batch(*commands), None
+            except mpd.CommandError as e:
+                result, error = None, e
 
     @dropin
     def next_songs(self):
         """Next songs in queue."""
-        status = MPDClient.client.currentsong()
-        pos = int(status["pos"])
-        include_keys = ["duration", "file", "pos"]
-        return [format_dict({k: v for k, v in song.items() if k in include_keys})
-                for song in MPDClient.client.playlistinfo((pos, )) +
-                MPDClient.client.playlistinfo((0, NEXT_LIST_LENGTH))
-                ][:NEXT_LIST_LENGTH]
+        pos = int(self.sync_playlist()["song"])
+        return format_next_songs(self.mirror, pos)
 
     @dropin
     def playlist(self):
-        include_keys = ["duration", "file", "pos"]
-        playlist = MPDClient.client.playlistinfo()
-        info = [format_dict({k: v for k, v in song.items() if k in include_keys})
-                for song in playlist]
-        duration = int(sum(float(song['duration']) for song in playlist))
-        status = MPDClient.client.status()
-        length = int(status["playlistlength"])
-        info.append(
-            f"                      Total duration: {datetime.timedelta(seconds=duration)}")
-        info.append(f"                      Total songs: {length}")
-        return info
+        _, songs, duration = self.playlist_snapshot()
+        return songs + format_playlist_footer(duration, len(songs))
+
+    @dropin
+    def playlist_snapshot(self) -> Tuple[int, List[str], int]:
+        """Playlist version, formatted songs and total duration, see
+        PlaylistMirror.formatted."""
+        self.sync_playlist()
+        return self.mirror.formatted()
 
     @dropin
     def surrounding_ids(self):
-        status = MPDClient.client.status()
-        playlist = MPDClient.client.playlistinfo()
-        return (playlist[int(status['song']) - 1]['id'], status["songid"], status["nextsongid"])
+        status = self.sync_playlist()
+        return (self.mirror.song_at(int(status['song']) - 1)['id'], status["songid"], status["nextsongid"])
 
     @dropin
     def song_from_id(self, id):
-        return MPDClient.client.playlistid(id)[0]
+        self.sync_playlist()
+        song = self.mirror.song(id)
+        if song is None:
+            raise mpd.base.CommandError(f"No such song {id=}")
+        return song
 
     @dropin
     def remove_id(self, id):
-        MPDClient.client.deleteid(id)
+        self.client.deleteid(id)
 
     @dropin
-    def add_next(self, song: str):
-        MPDClient.client.add(song)
-        status = MPDClient.client.currentsong()
-        pos = int(status["pos"])
-        status = MPDClient.client.status()
-        length = int(status["playlistlength"])
-        MPDClient.client.move(length - 1, pos + 1)
+    def add_next(self, song: str) -> str:
+        """Add a song right after the current one, returning its id."""
+        pos = int(self.client.status()["song"])
+        return self.client.addid(song, pos + 1)
 
     @dropin
     def pos(self):
-        return int(MPDClient.client.status()["song"])
+        return int(self.client.status()["song"])
 
     @dropin
     def length(self):
-        return int(MPDClient.client.status()["playlistlength"])
+        return int(self.client.status()["playlistlength"])
 
     @dropin
     def get_id_at_pos(self, pos: int):
-        return MPDClient.client.playlistinfo((pos, ))[0]["id"]
+        self.sync_playlist()
+        if not 0 <= pos < len(self.mirror):
+            raise mpd.base.CommandError(f"Bad song index {pos=}")
+        return self.mirror.song_at(pos)["id"]
 
     @dropin
-    def add_at_pos(self, song: str, pos: int, is_retry: bool = False):
+    def add_at_pos(self, song: str, pos: int) -> str:
+        """Add a song at pos, returning its id.
+
+        A freshly downloaded song is not in mpd's database yet, in that
+        case it gets updated and we wait for the update before retrying.
+        """
         try:
-            MPDClient.client.update(song)
-            MPDClient.client.add(song)
+            return self.client.addid(song, pos)
         except mpd.base.CommandError:
-            if is_retry:
-                raise AssertionError("Could not add song to playlist")
-            logger.info(f"New song... Retrying in {ADD_RETRY_DELAY} seconds")
-            time.sleep(ADD_RETRY_DELAY)
-            return self.add_at_pos(song, pos, True)
-        status = MPDClient.client.status()
-        length = int(status["playlistlength"])
-        MPDClient.client.move(length - 1, pos)
+            logger.info(f"New song, updating the database for {song=}")
+        job = self.client.update(song)
+        self._wait_for_update(job)
+        try:
+            return self.client.addid(song, pos)
+        except mpd.base.CommandError:
+            raise AssertionError("Could not add song to playlist")
+
+    def _wait_for_update(self, job: str, timeout: float = ADD_RETRY_DELAY):
+        deadline = time.monotonic() + timeout
+        while time.monotonic() < deadline:
+            if self.client.status().get("updating_db") != job:
+                return
+            time.sleep(UPDATE_POLL_INTERVAL)
+        logger.warning(f"Database update {job=} did not finish in {timeout}s")
 
     @dropin
     def next(self):
-        MPDClient.client.next()
+        self.client.next()
 
     @dropin
     def previous(self):
-        MPDClient.client.previous()
+        self.client.previous()
 
     @dropin
     @int_args
     def play(self, pos: int):
-        MPDClient.client.play(pos)
+        self.client.play(pos)
 
     @dropin
     @int_args
     def delete(self, pos: int):
-        MPDClient.client.delete(pos)
+        self.client.delete(pos)
 
     @dropin
     @int_args
     def move(self, pos: int, new_pos: int):
-        MPDClient.client.move(pos, new_pos)
+        self.client.move(pos, new_pos)
 
     async def wait_for_event(self, event="player"):
-        stream = await trio.open_tcp_stream(MPDClient._host, MPDClient._port)
-        async with stream:
-            while True:
-                response = await stream.receive_some(4096)
-                response = response.decode().strip()
-                if "OK MPD" in response:
-                    await stream.send_all(f"idle {event}\n".encode())
-                elif response.startswith("changed: "):
-                    return response.split(" ")[1]
+        """Wait for the next change of a subsystem. ``self.events.run``
+        must be running."""
+        with self.events.subscribe(event) as events:
+            return await events.receive()
+
+
+def _parse_pairs(lines: List[str]):
+    for line in lines:
+        key, _, value = line.partition(": ")
+        yield key.lower(), value
+
+
+def _parse_objects(lines: List[str], delimiters=("file", )) -> List[dict]:
+    objects = []
+    obj = {}
+    for key, value in _parse_pairs(lines):
+        if key in delimiters and obj:
+            objects.append(obj)
+            obj = {}
+        if key not in obj:
+            obj[key] = value
+        elif isinstance(obj[key], list):
+            obj[key].append(value)
+        else:
+            obj[key] = [obj[key], value]
+    if obj:
+        objects.append(obj)
+    return objects
+
+
+def _parse_object(lines: List[str]) -> dict:
+    objects = _parse_objects(lines, ())
+    return objects[0] if objects else {}
+
+
+def _parse_item(lines: List[str]) -> Optional[str]:
+    for _, value in _parse_pairs(lines):
+        return value
+
+
+# Shapes replies like python-mpd2 does so both clients return the same data
+_PARSERS = {
+    "status": _parse_object,
+    "currentsong": _parse_object,
+    "playlistinfo": _parse_objects,
+    "playlistid": _parse_objects,
+    "plchanges": _parse_objects,
+    "plchangesposid": lambda lines: _parse_objects(lines, ("cpos", )),
+    "addid": _parse_item,
+    "update": _parse_item,
+}
+
+
+def _format_command(name: str, args: tuple) -> str:
+    parts = [name]
+    for arg in args:
+        if isinstance(arg, tuple):
+            arg = f"{arg[0]}:" if len(arg) == 1 else f"{arg[0]}:{arg[1]}"
+        arg = str(arg).replace("\\", "\\\\").replace('"', '\\"')
+        parts.append(f'"{arg}"')
+    return " ".join(parts) + "\n"
+
+
+class AsyncMPDClient:
+    """trio native counterpart of MPDClient for the bot's coroutines.
+
+    Talks the mpd protocol over a persistent trio stream so a slow mpd
+    never blocks the event loop. Every command runs under its own
+    timeout, after which the connection is closed and reopened by the
+    next command. Shares the playlist mirror and idle listener with the
+    MPDClient instances of the same server.
+    """
+
+    def __init__(self, host, port, timeout: float = COMMAND_TIMEOUT):
+        self._host = host
+        self._port = port
+        self.timeout = timeout
+        self.mirror = MPDClient._mirrors.setdefault(
+            (host, port), PlaylistMirror())
+        self.events = MPDClient._listeners.setdefault(
+            (host, port), IdleListener(host, port))
+        self._stream: trio.SocketStream = None
+        self._lines: LineReader = None
+        self._lock = trio.Lock()
+
+    async def _connect(self):
+        self._stream = await trio.open_tcp_stream(self._host, self._port)
+        self._lines = LineReader(self._stream)
+        greeting = await self._lines.readline()
+        if not greeting.startswith("OK MPD"):
+            raise mpd.ProtocolError(f"Unexpected greeting: {greeting}")
+
+    async def close(self):
+        if self._stream is not None:
+            stream = self._stream
+            self._stream = None
+            await trio.aclose_forcefully(stream)
+
+    async def _execute(self, request: str) -> List[str]:
+        async with self._lock:
+            try:
+                with trio.fail_after(self.timeout):
+                    if self._stream is None:
+                        await self._connect()
+                    await self._stream.send_all(request.encode())
+                    response = []
+                    while True:
+                        line = await self._lines.readline()
+                        if line == "OK":
+                            return response
+                        if line.startswith("ACK "):
+                            raise mpd.CommandError(line[len("ACK "):])
+                        response.append(line)
+            except mpd.CommandError:
+                # The ACK ends the reply, the connection is still in sync
+                raise
+            except BaseException:
+                # Anything else, cancellation included, may leave a reply
+                # unread that the next command would take as its own
+                await self.close()
+                raise
+
+    async def command(self, name: str, *args):
+        with mpd_seconds.time(client="async", call=name):
+            try:
+                lines = await self._execute(_format_command(name, args))
+            except Exception:
+                mpd_errors.inc(client="async", call=name)
+                raise
+        parser = _PARSERS.get(name)
+        return parser(lines) if parser else None
+
+    async def batch(self, *commands: tuple) -> list:
+        """Async version of MPDClient.batch."""
+        request = "command_list_ok_begin\n" + \
+            "".join(_format_command(name, args) for name, *args in commands) + \
+            "command_list_end\n"
+        with mpd_seconds.time(client="async", call="batch"):
+            try:
+                response = await self._execute(request)
+            except Exception:
+                mpd_errors.inc(client="async", call="batch")
+                raise
+        results = []
+        lines = []
+        for line in response:
+            if line != "list_OK":
+                lines.append(line)
+                continue
+            parser = _PARSERS.get(commands[len(results)][0])
+            results.append(parser(lines) if parser else None)
+            lines = []
+        return results
+
+    async def cmd(self, cmd: str):
+        return await self.command(cmd)
+
+    async def current_song(self):
+        status, current = await self.batch(("status", ), ("currentsong", ))
+        return format_current_song(status, current)
+
+    async def current_song_name(self):
+        return format_data(await self.command("currentsong"), "file")
+
+    async def sync_playlist(self) -> dict:
+        """Async version of MPDClient.sync_playlist."""
+        steps = sync_steps(self.mirror)
+        result, error = None, None
+        while True:
+            try:
+                commands = steps.throw(error) if error else steps.send(result)
+            except StopIteration as done:
+                return done.value
+            try:
+                result, error = await self.batch(*commands), None
+            except mpd.CommandError as e:
+                result, error = None, e
+
+    async def next_songs(self):
+        """Next songs in queue."""
+        pos = int((await self.sync_playlist())["song"])
+        return format_next_songs(self.mirror, pos)
+
+    async def playlist(self):
+        _, songs, duration = await self.playlist_snapshot()
+        return songs + format_playlist_footer(duration, len(songs))
+
+    async def playlist_snapshot(self) -> Tuple[int, List[str], int]:
+        await self.sync_playlist()
+        return self.mirror.formatted()
+
+    async def surrounding_ids(self):
+        status = await self.sync_playlist()
+        return (self.mirror.song_at(int(status['song']) - 1)['id'], status["songid"], status["nextsongid"])
+
+    async def song_from_id(self, id):
+        await self.sync_playlist()
+        song = self.mirror.song(id)
+        if song is None:
+            raise mpd.CommandError(f"No such song {id=}")
+        return song
+
+    async def remove_id(self, id):
+        await self.command("deleteid", id)
+
+    async def add_next(self, song: str) -> str:
+        """Add a song right after the current one, returning its id."""
+        pos = int((await self.command("status"))["song"])
+        return await self.command("addid", song, pos + 1)
+
+    async def pos(self):
+        return int((await self.command("status"))["song"])
+
+    async def length(self):
+        return int((await self.command("status"))["playlistlength"])
+
+    async def get_id_at_pos(self, pos: int):
+        await self.sync_playlist()
+        if not 0 <= pos < len(self.mirror):
+            raise mpd.CommandError(f"Bad song index {pos=}")
+        return self.mirror.song_at(pos)["id"]
+
+    async def add_at_pos(self, song: str, pos: int) -> str:
+        """Async version of MPDClient.add_at_pos."""
+        try:
+            return await self.command("addid", song, pos)
+        except mpd.CommandError:
+            logger.info(f"New song, updating the database for {song=}")
+        job = await self.command("update", song)
+        with trio.move_on_after(ADD_RETRY_DELAY):
+            while (await self.command("status")).get("updating_db") == job:
+                await trio.sleep(UPDATE_POLL_INTERVAL)
+        try:
+            return await self.command("addid", song, pos)
+        except mpd.CommandError:
+            raise AssertionError("Could not add song to playlist")
 
+    async def next(self):
+        await self.command("next")
 
-async def mpd_loop_with_handler(handler: Callable, event: str = "player"):
-    c = MPDClient('localhost', 6600)
-    while True:
-        if await c.wait_for_event(event):
+    async def previous(self):
+        await self.command("previous")
+
+    @int_args
+    async def play(self, pos: int):
+        await self.command("play", pos)
+
+    @int_args
+    async def delete(self, pos: int):
+        await self.command("delete", pos)
+
+    @int_args
+    async def move(self, pos: int, new_pos: int):
+        await self.command("move", pos, new_pos)
+
+    async def wait_for_event(self, event="player"):
+        """Wait for the next change of a subsystem. ``self.events.run``
+        must be running."""
+        with self.events.subscribe(event) as events:
+            return await events.receive()
+
+
+async def mpd_loop_with_handler(handler: Callable, event: str = "player", client: MPDClient = None):
+    """Call handler on every change of the event subsystem. The idle
+    listener of a given client must be running, without one a local client
+    is made and listened to here."""
+    if client is None:
+        client = MPDClient('localhost', 6600)
+        async with trio.open_nursery() as nursery:
+            await nursery.start(client.events.run)
+            await mpd_loop_with_handler(handler, event, client)
+            nursery.cancel_scope.cancel()
+        return
+    with client.events.subscribe(event) as events:
+        async for _ in events:
             if asyncio.iscoroutinefunction(handler):
                 await handler()
             else:
                 handler()
-        await trio.sleep(0)
 
 
 async def main():
@@ -225,7 +966,9 @@ async def main():
     print(c.current_song())
     print(c.next_songs())
     print(c.playlist())
-    await mpd_loop_with_handler(lambda: print(c.current_song_name()))
+    async with trio.open_nursery() as nursery:
+        await nursery.start(c.events.run)
+        await mpd_loop_with_handler(lambda: print(c.current_song_name()), client=c)
 
 if __name__ == "__main__":
     trio.run(main)
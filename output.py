@@ -0,0 +1,219 @@
+################################################################################
+#      ____  ___    ____  ________     ____  ____  ______
+#     / __ \/   |  / __ \/  _/ __ \   / __ )/ __ \/_  __/
+#    / /_/ / /| | / / / // // / / /  / __  / / / / / /
+#   / _, _/ ___ |/ /_/ // // /_/ /  / /_/ / /_/ / / /
+#  /_/ |_/_/  |_/_____/___/\____/  /_____/\____/ /_/
+#
+#
+# Matheus Fillipe 18/05/2022
+# MIT License
+################################################################################
+
+
+import logging
+from collections import OrderedDict, deque
+from typing import Deque, Dict, List, Optional, Tuple, Union
+
+import trio
+from IrcBot.bot import IrcBot
+
+LINE_LIMIT = 512
+# Room left for the ":nick!user@host " prefix the server adds when relaying
+HOSTMASK_RESERVE = 100
+SEPARATOR = " | "
+# Bytes of text a line can always take, the longest utf-8 character
+MIN_LINE_LIMIT = 4
+# Lines per second and burst allowed to a single target
+TARGET_RATE = 1
+TARGET_BURST = 4
+# Lines per second and burst allowed on the whole connection
+RATE = 2
+BURST = 8
+
+# Lines of a paginated listing sent at once
+PAGE_SIZE = 20
+# Listings longer than this are pasted instead of sent line by line
+PASTE_THRESHOLD = 60
+
+# Priorities, lower is sent first
+INTERACTIVE = 0
+BULK = 1
+
+logger = logging.getLogger()
+
+
+class TokenBucket:
+    def __init__(self, rate: float, burst: int, now: float):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = float(burst)
+        self.updated = now
+
+    def refill(self, now: float):
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def delay(self, now: float) -> float:
+        """Seconds until a token is available."""
+        self.refill(now)
+        return max(0, (1 - self.tokens) / self.rate)
+
+    def take(self, now: float):
+        self.refill(now)
+        self.tokens -= 1
+
+    def full(self, now: float) -> bool:
+        self.refill(now)
+        return self.tokens >= self.burst
+
+
+def split_bytes(text: str, limit: int) -> List[str]:
+    """Split text in pieces of at most limit utf-8 bytes, not breaking
+    characters. A character longer than limit is a piece on its own."""
+    pieces = []
+    data = text.encode()
+    limit = max(limit, 0)
+    while len(data) > limit:
+        cut = limit
+        # Don't cut in the middle of a multibyte character
+        while cut > 0 and data[cut] & 0xC0 == 0x80:
+            cut -= 1
+        if cut == 0:
+            cut = 1
+            while cut < len(data) and data[cut] & 0xC0 == 0x80:
+                cut += 1
+        pieces.append(data[:cut].decode())
+        data = data[cut:]
+    if data or not pieces:
+        pieces.append(data.decode())
+    return pieces
+
+
+def pack(items: List[str], limit: int, separator: str = SEPARATOR) -> List[str]:
+    """Join consecutive items into lines of at most limit utf-8 bytes.
+    Items that don't fit in a line on their own are split."""
+    lines = []
+    line = ""
+    for item in items:
+        for piece in split_bytes(item, limit):
+            candidate = line + separator + piece if line else piece
+            if len(candidate.encode()) <= limit:
+                line = candidate
+                continue
+            if line:
+                lines.append(line)
+            line = piece
+    if line:
+        lines.append(line)
+    return lines
+
+
+class OutputScheduler:
+    """Rate limited sender for the bot's PRIVMSGs.
+
+    Each target gets its own token bucket on top of one for the whole
+    connection so the server never sees a flood. Targets are served round
+    robin, interactive lines always go before bulk output, so a long
+    listing doesn't hold back everyone else's replies.
+    """
+
+    def __init__(self, rate: float = RATE, burst: int = BURST,
+                 target_rate: float = TARGET_RATE, target_burst: int = TARGET_BURST):
+        self.rate = rate
+        self.burst = burst
+        self.target_rate = target_rate
+        self.target_burst = target_burst
+        self.queues: Dict[str, Tuple[Deque[str], Deque[str]]] = OrderedDict()
+        self.buckets: Dict[str, TokenBucket] = {}
+        self.bucket: Optional[TokenBucket] = None
+        self.wakeup = trio.Event()
+
+    def line_limit(self, target: str) -> int:
+        """Bytes of text that fit in a PRIVMSG to target."""
+        return LINE_LIMIT - HOSTMASK_RESERVE - len(f"PRIVMSG {target} :\r\n".encode())
+
+    def send(self, target: str, message: Union[str, List[str]], priority: int = INTERACTIVE,
+             prefix: str = "", packed: bool = False):
+        """Queue a message, or a list of them, to target. Returns
+        immediately.
+
+        When packed, the items are joined into as few lines as possible.
+        prefix is prepended to every line sent.
+        """
+        if isinstance(message, str):
+            message = [message]
+        message = [text.replace("\r", "").replace("\n", "    ") for text in message]
+        limit = max(self.line_limit(target) - len(prefix.encode()), MIN_LINE_LIMIT)
+        if packed:
+            lines = pack(message, limit)
+        else:
+            lines = [piece for text in message for piece in split_bytes(text, limit)]
+        if target not in self.queues:
+            self.queues[target] = (deque(), deque())
+        self.queues[target][priority].extend(prefix + line for line in lines)
+        self.wakeup.set()
+
+    def pending(self, target: str) -> int:
+        """Lines waiting to be sent to target."""
+        return sum(len(queue) for queue in self.queues.get(target, ()))
+
+    def cancel(self, target: str, priority: int = BULK) -> int:
+        """Drop the lines of a priority waiting to be sent to target,
+        returning how many."""
+        if target not in self.queues:
+            return 0
+        queue = self.queues[target][priority]
+        dropped = len(queue)
+        queue.clear()
+        return dropped
+
+    def _bucket(self, target: str, now: float) -> TokenBucket:
+        if target not in self.buckets:
+            self.buckets[target] = TokenBucket(self.target_rate, self.target_burst, now)
+        return self.buckets[target]
+
+    def _next(self, now: float) -> Tuple[Optional[str], float]:
+        """Target with the most urgent line that can be sent now, or None and
+        how long to wait for one."""
+        wait = float("inf")
+        best = None
+        for target, queues in list(self.queues.items()):
+            priority = next((p for p, queue in enumerate(queues) if queue), None)
+            if priority is None:
+                # Forget idle targets once they would start with a full bucket anyway
+                if self._bucket(target, now).full(now):
+                    del self.queues[target]
+                    del self.buckets[target]
+                continue
+            delay = self._bucket(target, now).delay(now)
+            if delay > 0:
+                wait = min(wait, delay)
+            elif best is None or priority < best[1]:
+                best = (target, priority)
+        if best is None:
+            return None, wait
+        return best[0], 0
+
+    async def run(self, bot: IrcBot, task_status=trio.TASK_STATUS_IGNORED):
+        self.bucket = TokenBucket(self.rate, self.burst, trio.current_time())
+        task_status.started()
+        while True:
+            now = trio.current_time()
+            target, wait = self._next(now)
+            if target is None:
+                self.wakeup = trio.Event()
+                with trio.move_on_after(wait):
+                    await self.wakeup.wait()
+                continue
+            delay = self.bucket.delay(now)
+            if delay > 0:
+                await trio.sleep(delay)
+                continue
+            queues = self.queues[target]
+            line = (queues[INTERACTIVE] or queues[BULK]).popleft()
+            self.bucket.take(now)
+            self._bucket(target, now).take(now)
+            # Served targets go to the back of the round robin
+            self.queues.move_to_end(target)
+            await bot.send_raw(f"PRIVMSG {target} :{line}")
@@ -0,0 +1,206 @@
+################################################################################
+#      ____  ___    ____  ________     ____  ____  ______
+#     / __ \/   |  / __ \/  _/ __ \   / __ )/ __ \/_  __/
+#    / /_/ / /| | / / / // // / / /  / __  / / / / / /
+#   / _, _/ ___ |/ /_/ // // /_/ /  / /_/ / /_/ / / /
+#  /_/ |_/_/  |_/_____/___/\____/  /_____/\____/ /_/
+#
+#
+# Matheus Fillipe 18/05/2022
+# MIT License
+################################################################################
+
+
+import logging
+import time
+from collections import OrderedDict, deque
+from dataclasses import dataclass
+from typing import Awaitable, Callable, Deque, Dict, Optional, Tuple
+
+import trio
+
+from sonic_pi import LogListener, Server, Submission
+
+# Seconds between programs reaching sonic pi, so scsynth isn't flooded
+DISPATCH_INTERVAL = 1
+# Seconds between programs replayed after a stop
+REPLAY_INTERVAL = 0.2
+# Programs a user can have waiting
+MAX_QUEUED = 3
+# Users that can have programs running at once, the one running for the
+# longest is stopped to make room for another
+MAX_RUNNING = 4
+# Programs of a user replayed after another user's are stopped
+MAX_PROGRAMS = 4
+# Seconds a program is assumed to keep running when sonic pi's log isn't
+# followed to learn when it completes
+PROGRAM_TTL = 900
+
+logger = logging.getLogger()
+
+
+@dataclass
+class Program:
+    code: str
+    # Where errors are reported to
+    target: str
+    # When it was last sent to sonic pi
+    started: Optional[float] = None
+    # Tells when its last run finished, if the log is followed
+    submission: Optional[Submission] = None
+
+
+class Scheduler:
+    """Sends the users' programs to sonic pi one at a time.
+
+    Waiting programs are served round robin between users, paced by
+    interval. Sonic pi can only stop every job at once, so the programs
+    running for each user are remembered: stopping a user's stops
+    everything and replays everyone else's. Programs are forgotten once
+    the log shows their run completed, or after PROGRAM_TTL without a log.
+    When max_running users have programs running, the one that started
+    first is stopped for the next.
+    """
+
+    class QueueFull(Exception):
+        pass
+
+    def __init__(self, server: Server, logs: Optional[LogListener] = None,
+                 interval: float = DISPATCH_INTERVAL, max_running: int = MAX_RUNNING):
+        self.server = server
+        self.logs = logs
+        self.interval = interval
+        self.max_running = max_running
+        self.queues: Dict[str, Deque[Program]] = OrderedDict()
+        # By the time each user started running programs
+        self.running: Dict[str, Deque[Program]] = OrderedDict()
+        self.restart = False
+        self.wakeup = trio.Event()
+
+    def submit(self, nick: str, target: str, code: str) -> int:
+        """Queue a program of nick, returning how many programs are waiting
+        before it. Raises QueueFull."""
+        queue = self.queues.setdefault(nick, deque())
+        if len(queue) >= MAX_QUEUED:
+            raise Scheduler.QueueFull(f"You already have {len(queue)} programs waiting")
+        queue.append(Program(code, target))
+        self.wakeup.set()
+        rounds = len(queue)
+        # Others get a turn for each of the programs of nick waiting first
+        return rounds - 1 + sum(min(len(other), rounds) for user, other in self.queues.items()
+                                if user != nick)
+
+    def pending(self) -> int:
+        return sum(len(queue) for queue in self.queues.values())
+
+    def _alive(self, program: Program) -> bool:
+        if program.submission is not None:
+            return not program.submission.finished
+        if self.logs is None and program.started is not None:
+            return time.monotonic() - program.started < PROGRAM_TTL
+        # Not sent yet or waiting for its replay
+        return True
+
+    def _expire(self):
+        """Forget the programs that are done running."""
+        for nick, programs in list(self.running.items()):
+            alive = [program for program in programs if self._alive(program)]
+            if not alive:
+                del self.running[nick]
+            elif len(alive) < len(programs):
+                self.running[nick] = deque(alive, maxlen=MAX_PROGRAMS)
+
+    def is_running(self, nick: str) -> bool:
+        self._expire()
+        return nick in self.running
+
+    def stop(self, nick: str) -> bool:
+        """Stop and drop the programs of nick, returning whether it had
+        any."""
+        self._expire()
+        queued = self.queues.pop(nick, None)
+        running = self.running.pop(nick, None)
+        if running:
+            self.restart = True
+            self.wakeup.set()
+        return bool(queued or running)
+
+    def stop_all(self):
+        self.queues.clear()
+        self.running.clear()
+        self.restart = True
+        self.wakeup.set()
+
+    def _next(self) -> Tuple[Optional[str], Optional[Program]]:
+        for nick, queue in list(self.queues.items()):
+            if not queue:
+                del self.queues[nick]
+                continue
+            # Served users go to the back of the round robin
+            self.queues.move_to_end(nick)
+            return nick, queue.popleft()
+        return None, None
+
+    async def _send(self, nick: str, program: Program, handler: Callable[[str, str, str], Awaitable]):
+        code = program.code
+        if self.logs is not None:
+            code, program.submission = self.logs.tag(nick, program.target, code)
+        program.started = time.monotonic()
+        try:
+            await trio.to_thread.run_sync(self.server.run_code, code)
+        except Server.SendError as e:
+            await handler(program.target, nick, f"Failed to send code to sonic pi: {e}")
+
+    async def _restart(self, handler: Callable[[str, str, str], Awaitable]):
+        """Stop every job and replay the programs still running."""
+        self.restart = False
+        self._expire()
+        # The stopped runs completing must not drop them before their replay
+        programs = [program for programs in self.running.values() for program in programs]
+        submissions = [program.submission for program in programs]
+        for program in programs:
+            program.submission = None
+        try:
+            await trio.to_thread.run_sync(self.server.stop_all_jobs)
+        except Server.SendError as e:
+            logger.error(f"Failed to stop sonic pi: {e}")
+            # Still running, their runs will tell when they complete
+            for program, submission in zip(programs, submissions):
+                program.submission = submission
+            return
+        for nick, programs in list(self.running.items()):
+            for program in list(programs):
+                if self.restart:
+                    # Stopped again meanwhile
+                    return
+                await trio.sleep(REPLAY_INTERVAL)
+                await self._send(nick, program, handler)
+
+    async def run(self, handler: Callable[[str, str, str], Awaitable],
+                  task_status=trio.TASK_STATUS_IGNORED):
+        """Dispatch programs, calling handler(target, nick, text) to tell a
+        user something went wrong."""
+        task_status.started()
+        while True:
+            if self.restart:
+                await self._restart(handler)
+                continue
+            nick, program = self._next()
+            if nick is None:
+                self.wakeup = trio.Event()
+                await self.wakeup.wait()
+                continue
+            self._expire()
+            if nick not in self.running and len(self.running) >= self.max_running:
+                evicted, programs = self.running.popitem(last=False)
+                logger.info(f"Stopping the sonic pi programs of {evicted=} for {nick=}")
+                await handler(programs[-1].target, evicted,
+                              "Your sonic pi code was stopped to make room for others")
+                self.restart = True
+            self.running.setdefault(nick, deque(maxlen=MAX_PROGRAMS)).append(program)
+            if self.restart:
+                # Replays this one too
+                await self._restart(handler)
+            else:
+                await self._send(nick, program, handler)
+            await trio.sleep(self.interval)
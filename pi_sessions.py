@@ -0,0 +1,185 @@
+################################################################################
+#      ____  ___    ____  ________     ____  ____  ______
+#     / __ \/   |  / __ \/  _/ __ \   / __ )/ __ \/_  __/
+#    / /_/ / /| | / / / // // / / /  / __  / / / / / /
+#   / _, _/ ___ |/ /_/ // // /_/ /  / /_/ / /_/ / / /
+#  /_/ |_/_/  |_/_____/___/\____/  /_____/\____/ /_/
+#
+#
+# Matheus Fillipe 18/05/2022
+# MIT License
+################################################################################
+
+
+import json
+import logging
+import os
+import time
+from collections import deque
+from typing import Dict, Iterable, List, Optional
+
+# Caps of the code typed while a repl is live
+MAX_SESSION_LINES = 200
+MAX_SESSION_BYTES = 16 * 1024
+# Caps of the evaluated code kept for paste, the oldest lines are dropped
+MAX_HISTORY_LINES = 500
+MAX_HISTORY_BYTES = 64 * 1024
+# Seconds before an untouched repl is closed
+SESSION_TIMEOUT = 3600
+# Seconds before the history of a user that stopped using the repl is dropped
+HISTORY_TIMEOUT = 7 * 24 * 3600
+SWEEP_INTERVAL = 60
+
+logger = logging.getLogger()
+
+
+class RingBuffer:
+    """Lines capped both in count and total utf-8 bytes, dropping the oldest
+    ones to make room."""
+
+    def __init__(self, max_lines: int, max_bytes: int, lines: Iterable[str] = ()):
+        self.max_lines = max_lines
+        self.max_bytes = max_bytes
+        self.lines = deque()
+        self.size = 0
+        self.extend(lines)
+
+    def __len__(self) -> int:
+        return len(self.lines)
+
+    def __iter__(self):
+        return iter(self.lines)
+
+    def append(self, line: str):
+        line = line.encode()[:self.max_bytes].decode(errors="ignore")
+        self.lines.append(line)
+        self.size += len(line.encode())
+        while len(self.lines) > self.max_lines or self.size > self.max_bytes:
+            self.size -= len(self.lines.popleft().encode())
+
+    def extend(self, lines: Iterable[str]):
+        for line in lines:
+            self.append(line)
+
+
+class Session:
+    """Code being typed in a live repl."""
+
+    def __init__(self):
+        self.lines: List[str] = []
+        self.size = 0
+        self.dropped = 0
+        self.touched = time.monotonic()
+
+    def add(self, line: str) -> bool:
+        """Append a line, returning False if it doesn't fit the caps."""
+        self.touched = time.monotonic()
+        size = len(line.encode())
+        if len(self.lines) >= MAX_SESSION_LINES or self.size + size > MAX_SESSION_BYTES:
+            self.dropped += 1
+            return False
+        self.lines.append(line)
+        self.size += size
+        return True
+
+
+class SessionStore:
+    """Live Sonic Pi repls and the history of evaluated code of each user.
+
+    Everything is capped: repls by line count and bytes, histories by a
+    ring buffer, and both expire when left untouched. Histories are saved
+    to path, if given, to survive restarts.
+    """
+
+    def __init__(self, path: Optional[str] = None):
+        self.path = os.path.expanduser(path) if path else None
+        self.sessions: Dict[str, Session] = {}
+        self.histories: Dict[str, RingBuffer] = {}
+        # Wall clock, so it can be persisted
+        self.history_touched: Dict[str, float] = {}
+        self.last_sweep = time.monotonic()
+        self.load()
+
+    def is_live(self, nick: str) -> bool:
+        return nick in self.sessions
+
+    def start(self, nick: str, lines: Iterable[str] = ()) -> Session:
+        """Open a repl for nick, replacing any open one."""
+        self.sweep()
+        session = self.sessions[nick] = Session()
+        for line in lines:
+            session.add(line)
+        return session
+
+    def add_line(self, nick: str, line: str) -> Optional[Session]:
+        """Append a line to the repl of nick, returning the session if it has
+        one."""
+        session = self.sessions.get(nick)
+        if session is not None:
+            session.add(line)
+        return session
+
+    def finish(self, nick: str) -> List[str]:
+        """Close the repl of nick, moving its code to the history and
+        returning it."""
+        session = self.sessions.pop(nick)
+        if nick not in self.histories:
+            self.histories[nick] = RingBuffer(MAX_HISTORY_LINES, MAX_HISTORY_BYTES)
+        self.histories[nick].extend(session.lines)
+        self.history_touched[nick] = time.time()
+        self.save()
+        return session.lines
+
+    def history(self, nick: str) -> List[str]:
+        return list(self.histories.get(nick, ()))
+
+    def clear_history(self, nick: str):
+        self.histories.pop(nick, None)
+        self.history_touched.pop(nick, None)
+        self.save()
+
+    def sweep(self):
+        """Drop expired repls and histories, at most once per
+        SWEEP_INTERVAL."""
+        now = time.monotonic()
+        if now - self.last_sweep < SWEEP_INTERVAL:
+            return
+        self.last_sweep = now
+        for nick in [n for n, s in self.sessions.items() if now - s.touched > SESSION_TIMEOUT]:
+            logger.info(f"Closing idle sonic pi repl of {nick=}")
+            del self.sessions[nick]
+        deadline = time.time() - HISTORY_TIMEOUT
+        expired = [n for n, t in self.history_touched.items() if t < deadline]
+        for nick in expired:
+            del self.histories[nick]
+            del self.history_touched[nick]
+        if expired:
+            self.save()
+
+    def load(self):
+        if not self.path or not os.path.isfile(self.path):
+            return
+        try:
+            with open(self.path) as f:
+                data = json.load(f)
+        except (OSError, ValueError) as e:
+            logger.error(f"Failed to load sonic pi history from {self.path}: {e}")
+            return
+        for nick, entry in data.items():
+            self.histories[nick] = RingBuffer(
+                MAX_HISTORY_LINES, MAX_HISTORY_BYTES, entry["lines"])
+            self.history_touched[nick] = entry["touched"]
+
+    def save(self):
+        if not self.path:
+            return
+        data = {nick: {"lines": list(lines), "touched": self.history_touched[nick]}
+                for nick, lines in self.histories.items()}
+        tmp_path = self.path + ".tmp"
+        try:
+            os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+            with open(tmp_path, "w") as f:
+                json.dump(data, f)
+            os.replace(tmp_path, self.path)
+        except OSError as e:
+            logger.error(f"Failed to save sonic pi history to {self.path}: {e}")
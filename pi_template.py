@@ -0,0 +1,94 @@
+################################################################################
+#      ____  ___    ____  ________     ____  ____  ______
+#     / __ \/   |  / __ \/  _/ __ \   / __ )/ __ \/_  __/
+#    / /_/ / /| | / / / // // / / /  / __  / / / / / /
+#   / _, _/ ___ |/ /_/ // // /_/ /  / /_/ / /_/ / / /
+#  /_/ |_/_/  |_/_____/___/\____/  /_____/\____/ /_/
+#
+#
+# Matheus Fillipe 18/05/2022
+# MIT License
+################################################################################
+
+
+import re
+from functools import lru_cache
+from typing import List, Tuple, Union
+
+from sonic_pi import NoteNotFound, convert_many
+
+DEFAULT_OCTAVE = 4
+EXPANSION_CACHE_SIZE = 4096
+PLACEHOLDER_RE = re.compile(r"\$\{([^}\n]+?)\}")
+
+
+class UnknownNotes(Exception):
+    def __init__(self, keys: List[str]):
+        super().__init__(", ".join(repr(key) for key in keys))
+        self.keys = keys
+
+
+def parse_spec(args: List[str]) -> Tuple[str, int, int]:
+    """Letters, octave and transpose of ``[octave] [±transpose] <letters>``
+    arguments."""
+    octave = DEFAULT_OCTAVE
+    transpose = 0
+    if args and args[0].isdigit():
+        octave = int(args[0])
+        args = args[1:]
+    if args and args[0][:1] in ("+", "-") and args[0][1:].isdigit():
+        transpose = int(args[0])
+        args = args[1:]
+    return "".join(args), octave, transpose
+
+
+@lru_cache(maxsize=EXPANSION_CACHE_SIZE)
+def expand(letters: str, octave: int, transpose: int = 0) -> str:
+    """Comma separated sonic pi notes of letters. Can raise NoteNotFound."""
+    return ", ".join(convert_many([(letters, octave, transpose)])[0])
+
+
+def convert(*args: str) -> str:
+    """Notes of ``[octave] [±transpose] <letters>`` arguments. Can raise
+    NoteNotFound."""
+    letters, octave, transpose = parse_spec(list(args))
+    if not letters:
+        raise NoteNotFound("")
+    return expand(letters, octave, transpose)
+
+
+class Template:
+    """A program with ``${[octave] [±transpose] <letters>}`` placeholders
+    expanding to notes.
+
+    The program is tokenized once into literal text and parsed
+    placeholders, rendering it is a single pass over them.
+    """
+
+    def __init__(self, code: str):
+        self.parts: List[Union[str, Tuple[str, int, int]]] = []
+        start = 0
+        for match in PLACEHOLDER_RE.finditer(code):
+            self.parts.append(code[start:match.start()])
+            self.parts.append(parse_spec(match.group(1).split()))
+            start = match.end()
+        self.parts.append(code[start:])
+
+    def render(self) -> str:
+        """The program with every placeholder expanded.
+
+        Raises UnknownNotes listing every key that isn't a note.
+        """
+        specs = list(dict.fromkeys(
+            part for part in self.parts if not isinstance(part, str) and part[0]))
+        # Placeholders without letters, like "${4}"
+        unknown = [""] if any(not isinstance(part, str) and not part[0] for part in self.parts) else []
+        expanded = {}
+        for spec in specs:
+            try:
+                expanded[spec] = expand(*spec)
+            except NoteNotFound as e:
+                unknown.extend(key for key in e.keys if key not in unknown)
+        if unknown:
+            raise UnknownNotes(unknown)
+        return "".join(part if isinstance(part, str) else expanded[part] for part in self.parts)
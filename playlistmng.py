@@ -11,52 +11,197 @@
 ################################################################################
 
 
+import os
 import threading
+import time
+from collections import OrderedDict, deque
 from copy import deepcopy
-from dataclasses import dataclass
+from dataclasses import dataclass, field
+from itertools import count
 from logging import getLogger
+from typing import Callable, List, Optional, Set
 
 from mpd.base import CommandError
 
-from mpd_client import MPDClient
+from library import Library
+from metrics import registry
+from mpd_client import ACK_NO_EXIST, ACK_RE, MPDClient
 
 logger = getLogger()
-
-
-class ThreadPool:
-    """A very dumb thread pool implementation.
-
-    The only goal here is to limit the number of simulaneous thread that
-    can be run and encapsulate the threading module.
+job_wait_seconds = registry.histogram("mpdbot_job_wait_seconds", "Time jobs wait for a worker")
+job_run_seconds = registry.histogram("mpdbot_job_run_seconds", "Time jobs take to run, by outcome")
+jobs_rejected = registry.counter("mpdbot_jobs_rejected_total", "Jobs refused because the queue was full")
+
+MAX_QUEUED_JOBS = 32
+JOB_TIMEOUT = 600
+WATCHDOG_INTERVAL = 1
+
+_local = threading.local()
+
+
+def current_job() -> Optional["Job"]:
+    """Job being run by the current worker thread, if any."""
+    return getattr(_local, "job", None)
+
+
+@dataclass(eq=False)
+class Job:
+    id: int
+    user: str
+    worker: Callable
+    args: tuple
+    kwargs: dict
+    timeout: float
+    on_timeout: Optional[Callable] = None
+    queued_at: float = field(default_factory=time.monotonic)
+    started_at: Optional[float] = None
+    timed_out: bool = False
+    cancelled: threading.Event = field(default_factory=threading.Event)
+
+
+class JobQueue:
+    """Bounded job queue served by a fixed number of worker threads.
+
+    Waiting jobs are dispatched round robin between users so a burst
+    from one of them doesn't hold everyone else back. Jobs can be
+    cancelled and have a timeout. Threads can't be killed, so a worker
+    that times out is replaced by a new one, its job is flagged as
+    cancelled and the late thread exits once it returns. Workers should
+    check ``current_job().cancelled`` before doing anything visible.
     """
 
     class FullError(Exception):
         pass
 
-    def __init__(self, max_threads):
-        self.max_threads = max_threads
-        self.threads = []
-        self.lock = threading.Lock()
+    def __init__(self, workers: int, max_queued: int = MAX_QUEUED_JOBS, timeout: float = JOB_TIMEOUT):
+        self.max_queued = max_queued
+        self.timeout = timeout
+        self.queues = OrderedDict()
+        self.running = set()
+        self.cond = threading.Condition()
+        self._ids = count(1)
+        for _ in range(workers):
+            self._spawn(self._work)
+        self._spawn(self._watchdog)
 
-    def add_task(self, worker, *args, **kwargs):
-        """Add a task to the thread pool."""
-        with self.lock:
-            if len(self.threads) >= self.max_threads:
-                raise ThreadPool.FullError()
-            def wrapped_worker(*args, **kwargs):
-                worker(*args, **kwargs)
-                self.threads.remove(thread)
-            thread = threading.Thread(
-                target=wrapped_worker, args=args, kwargs=kwargs, daemon=True)
-            self.threads.append(thread)
-            thread.start()
-
-    def wait_completion(self):
-        """Wait for all threads to complete."""
+    def _spawn(self, target: Callable):
+        threading.Thread(target=target, daemon=True).start()
+
+    def __len__(self) -> int:
+        """Number of waiting jobs."""
+        return sum(len(jobs) for jobs in self.queues.values())
+
+    def submit(self, user: str, worker: Callable, *args, on_timeout: Callable = None, **kwargs) -> Job:
+        """Queue worker(*args, **kwargs) on behalf of user.
+
+        on_timeout is called with the job if it takes too long. Can raise
+        FullError.
+        """
+        with self.cond:
+            if len(self) >= self.max_queued:
+                jobs_rejected.inc()
+                raise JobQueue.FullError()
+            job = Job(next(self._ids), user, worker, args,
+                      kwargs, self.timeout, on_timeout)
+            self.queues.setdefault(user, deque()).append(job)
+            self.cond.notify()
+        logger.debug(f"Queued {job.id=} for {user=}")
+        return job
+
+    def position(self, job: Job) -> int:
+        """Place of a job in the dispatch order, starting at 1. 0 means it
+        is already running or is gone."""
+        with self.cond:
+            users = list(self.queues)
+            if job.user not in self.queues or job not in self.queues[job.user]:
+                return 0
+            index = self.queues[job.user].index(job)
+            user_index = users.index(job.user)
+            ahead = 0
+            for i, user in enumerate(users):
+                rounds = index + 1 if i < user_index else index
+                ahead += min(len(self.queues[user]), rounds)
+            return ahead + 1
+
+    def user_jobs(self, user: str) -> List[Job]:
+        """Waiting and running jobs of a user."""
+        with self.cond:
+            return list(self.queues.get(user, [])) + \
+                [job for job in self.running if job.user == user]
+
+    def cancel(self, user: str) -> List[Job]:
+        """Cancel every waiting and running job of a user."""
+        with self.cond:
+            jobs = self.user_jobs(user)
+            self.queues.pop(user, None)
+        for job in jobs:
+            job.cancelled.set()
+        logger.info(f"Cancelled {len(jobs)} jobs of {user=}")
+        return jobs
+
+    def _next_job(self) -> Job:
+        user, jobs = self.queues.popitem(last=False)
+        job = jobs.popleft()
+        if jobs:
+            # Back of the line until every other user had a turn
+            self.queues[user] = jobs
+        return job
+
+    def _work(self):
+        while True:
+            with self.cond:
+                while not self.queues:
+                    self.cond.wait()
+                job = self._next_job()
+                job.started_at = time.monotonic()
+                self.running.add(job)
+            job_wait_seconds.observe(job.started_at - job.queued_at)
+            _local.job = job
+            outcome = "ok"
+            try:
+                job.worker(*job.args, **job.kwargs)
+            except Exception as e:
+                outcome = "error"
+                logger.error(f"Job {job.id} of {job.user} failed: {e}")
+            finally:
+                _local.job = None
+                with self.cond:
+                    self.running.discard(job)
+                if job.timed_out:
+                    outcome = "timeout"
+                elif job.cancelled.is_set():
+                    outcome = "cancelled"
+                job_run_seconds.observe(time.monotonic() - job.started_at, outcome=outcome)
+            if job.timed_out:
+                # A replacement worker was already started
+                return
+
+    def _watchdog(self):
+        while True:
+            time.sleep(WATCHDOG_INTERVAL)
+            now = time.monotonic()
+            with self.cond:
+                expired = [job for job in self.running
+                           if not job.timed_out and now - job.started_at > job.timeout]
+                for job in expired:
+                    job.timed_out = True
+                    job.cancelled.set()
+                    self._spawn(self._work)
+            for job in expired:
+                logger.warning(f"Job {job.id} of {job.user} timed out")
+                if job.on_timeout:
+                    try:
+                        job.on_timeout(job)
+                    except Exception as e:
+                        logger.error(f"Timeout handler of job {job.id} failed: {e}")
+
+
+def synchronized(func):
+    """Decorator that runs the method holding the instance's lock."""
+    def wrapper(self, *args, **kwargs):
         with self.lock:
-            for thread in self.threads:
-                thread.join()
-            self.threads = []
+            return func(self, *args, **kwargs)
+    return wrapper
 
 
 @dataclass
@@ -84,19 +229,23 @@ class SongQueue:
         self.max_len = max_len
         self.mpd_client = mpd_client
         self.last_pos = None
+        # Updates run off the trio loop, concurrently with the download workers
+        self.lock = threading.RLock()
 
     def __len__(self) -> int:
         return sum(len(self.queues[user]) for user in self.queues)
 
     def next_pos(self) -> int:
         """Return the position of the next song to be added."""
-        pos = self.mpd_client.pos()
+        status = self.mpd_client.cmd("status")
+        pos = int(status["song"])
         logger.debug(f"Current position is {pos=}")
         if self.last_pos is None:
             return pos + 1
-        max_pos = self.mpd_client.length()
+        max_pos = int(status["playlistlength"])
         return min(max(self.last_pos, pos) + 1, max_pos)
 
+    @synchronized
     def add_song(self, user: str, uri: str) -> Song:
         """Add a song to the queue.
 
@@ -108,11 +257,10 @@ class SongQueue:
             raise SongQueue.FullUserError()
         pos = self.next_pos()
         try:
-            self.mpd_client.add_at_pos(uri, pos)
+            song_id = self.mpd_client.add_at_pos(uri, pos)
         except AttributeError:
             logger.error("Failed to add song to queue")
             raise AttributeError("Failed to add song to queue")
-        song_id = self.mpd_client.get_id_at_pos(pos)
         song = Song(song_id, uri, user)
         self.queues[user].append(song)
         logger.info(
@@ -120,12 +268,13 @@ class SongQueue:
         self.last_pos = pos
         return song
 
-    def can_add(self, user: str) -> bool:
-        """Return whether a user can add a song to the queue."""
+    def can_add(self, user: str, pending: int = 0) -> bool:
+        """Return whether a user can add a song to the queue, counting
+        pending songs that are still being downloaded."""
         try:
-            return len(self.queues[user]) < self.max_len
+            return len(self.queues[user]) + pending < self.max_len
         except KeyError:
-            return True
+            return pending < self.max_len
 
     def user_songs(self, user: str) -> [Song]:
         """Return the songs of a user."""
@@ -138,20 +287,26 @@ class SongQueue:
             songs.extend(self.queues[user])
         return songs
 
-    def keep_all(self, user: str):
+    @synchronized
+    def keep_all(self, user: str) -> List[Song]:
         """Keep all songs of a user, removing them from the queue if in any,
-        making sure they won't be automatically removed.
+        making sure they won't be automatically removed. Returns the kept
+        songs.
 
         Can raise KeyError.
         """
+        kept = []
         for song in deepcopy(self.queues[user]):
             self.queues[user].remove(song)
+            kept.append(song)
             logger.info(
                 f"Keeping song {song.id=} from queue of {song.from_nick=}")
+        return kept
 
-    def keep_song(self, pos: int):
+    @synchronized
+    def keep_song(self, pos: int) -> Song:
         """Stops tracking a song, removing it from the queue if in any, making
-        sure it wont get automatically removed.
+        sure it wont get automatically removed. Returns the kept song.
 
         Can raise PositionNotFoundError and KeyError.
         """
@@ -165,9 +320,10 @@ class SongQueue:
                     self.queues[user].remove(song)
                     logger.info(
                         f"Keeping song {song_id=} from queue of {user=} at pos {pos=}")
-                    return True
+                    return song
         raise SongQueue.PositionNotFoundError()
 
+    @synchronized
     def update(self):
         """Update the queue by removing songs that are no longer in the user's
         queue.
@@ -175,58 +331,159 @@ class SongQueue:
         A song will be removed when its id is the previous one or the current position is greater than its.
         """
         logger.debug("Updating queue")
-        prev_id, id, next_id = self.mpd_client.surrounding_ids()
-        logger.debug(f"{prev_id=}, {id=}, {next_id=}")
-        pos = self.mpd_client.pos()
+        status = self.mpd_client.sync_playlist()
+        mirror = self.mpd_client.mirror
+        pos = int(status["song"])
+        prev_id = mirror.song_at(pos - 1)["id"]
+        logger.debug(f"{prev_id=}, {pos=}")
+        played = []
         for user in self.queues:
-            for song in deepcopy(self.queues[user]):
+            for song in self.queues[user]:
                 # Clear all on playlist reset or when the song is the previous
                 logger.debug(f"Checking {song.id=}")
-                if pos == 0 or song.id == prev_id or pos > int(self.mpd_client.song_from_id(song.id)['pos']):
-                    self.queues[user].remove(song)
-                    self.mpd_client.remove_id(song.id)
-                    logger.info(
-                        f"Removed song {song.id=} from queue of {user=}")
-
-
-async def test():
-    # TODO write proper tests someday (a mpd mock server? damn)
-    import logging
-
-    from mpd_client import mpd_loop_with_handler
-    logging.basicConfig(level=logging.DEBUG)
-    songs = ["_mpdbot/wwwyoutubecomwatchvfsbpwd-bac0.m4a",
-             "_mpdbot/epica-rivers-official-visualizer.mp3"]
-    client = MPDClient("localhost", 6600)
+                song_pos = mirror.position_of(song.id)
+                if pos == 0 or song.id == prev_id or song_pos is None or pos > song_pos:
+                    played.append((user, song))
+        # Only untrack what actually left the playlist, a failed delete is
+        # retried on the next update
+        gone = self._delete_ids([song.id for _, song in played
+                                 if mirror.position_of(song.id) is not None])
+        for user, song in played:
+            if mirror.position_of(song.id) is None or song.id in gone:
+                self.queues[user].remove(song)
+                logger.info(
+                    f"Removed song {song.id=} from queue of {user=}")
+
+    def _delete_ids(self, ids: List[str]) -> Set[str]:
+        """Delete songs from the playlist in as few command lists as
+        possible, returning the ids that are no longer in it."""
+        gone = set()
+        while ids:
+            try:
+                self.mpd_client.batch(*[("deleteid", id) for id in ids])
+                gone.update(ids)
+                break
+            except CommandError as e:
+                # mpd runs a command list up to the failing command
+                match = ACK_RE.search(str(e))
+                if not match:
+                    logger.error(f"Failed to delete songs {ids=}: {e}")
+                    break
+                code, index = int(match[1]), int(match[2])
+                gone.update(ids[:index])
+                if code == ACK_NO_EXIST:
+                    gone.add(ids[index])
+                else:
+                    logger.error(f"Failed to delete song {ids[index]}: {e}")
+                ids = ids[index + 1:]
+        return gone
+
+
+def evict_downloads(library: Library, client: MPDClient, quota: int,
+                    music_dir: str, folder: str) -> List[str]:
+    """Evict the least recently played downloads that aren't in the
+    playlist until the library fits in quota bytes, then rescan folder once.
+    Returns the evicted paths."""
+    music_dir = os.path.expanduser(music_dir)
+    client.sync_playlist()
+    queued = {os.path.normpath(os.path.join(music_dir, song["file"]))
+              for song in client.mirror.slice()}
+    evicted = library.evict(quota, queued)
+    if evicted:
+        client.update(folder)
+    return evicted
+
+
+def _test_queue(client: MPDClient, songs: List[str]):
+    client.batch(("add", songs[0]), ("add", songs[1]), ("play", 0))
     queue = SongQueue(3, client)
     queue.add_song("test", songs[0])
     queue.add_song("test", songs[0])
     queue.add_song("test", songs[1])
     try:
         queue.add_song("test", songs[1])
-        raise ValueError()
+        raise AssertionError("A fourth song was accepted")
     except SongQueue.FullUserError:
         pass
     queue.add_song("otherguy", songs[0])
     pos = queue.next_pos()
     queue.add_song("otherguy", songs[1])
     queue.add_song("thirdguy", songs[0])
-    queue.keep_song(pos)
+    assert queue.keep_song(pos).from_nick == "otherguy"
     queue.add_song("thirdguy", songs[1])
     queue.add_song("thirdguy", songs[1])
     try:
         queue.add_song("thirdguy", songs[1])
-        raise ValueError()
+        raise AssertionError("A fourth song was accepted")
     except SongQueue.FullUserError:
         pass
     try:
         queue.keep_song(12031)
-        raise ValueError()
+        raise AssertionError("Kept a song past the end of the playlist")
     except SongQueue.PositionNotFoundError:
         pass
-    print(queue.user_songs("test"))
+    assert len(queue) == 7
+    # Every song went right after the previous one, after the current song
+    playlist = client.cmd("playlistinfo")
+    kept = playlist[5]
+    assert kept["file"] == songs[1]
+    assert [song["id"] for song in playlist[1:9]] == [song.id for song in queue.user_songs("test")] + \
+        [queue.user_songs("otherguy")[0].id, kept["id"]] + [song.id for song in queue.user_songs("thirdguy")]
+
+    # Songs leave the queue and the playlist once the next one is playing
+    for queued in [7, 6, 5]:
+        client.next()
+        queue.update()
+        assert len(queue) == queued, (len(queue), queued)
+    assert len(client.cmd("playlistinfo")) == len(playlist) - 2
     print(queue.all_songs())
-    await mpd_loop_with_handler(queue.update)
+
+
+def _test_eviction(client: MPDClient, music_dir: str, songs: List[str]):
+    import library as library_module
+    library_module.EVICTION_GRACE = 0
+    library = Library(os.path.join(music_dir, "library.db"))
+    paths = [os.path.join(music_dir, uri) for uri in songs]
+    for path in paths:
+        with open(path, "wb") as f:
+            f.write(b"\0" * 100)
+        library.add_file(path, path, 100)
+    client.cmd("clear")
+    client.batch(("add", songs[0]), ("play", 0))
+    # The playing song is the oldest but stays, the next one is evicted
+    assert evict_downloads(library, client, 150, music_dir, "_mpdbot") == [paths[1]]
+    assert not os.path.exists(paths[1]) and os.path.exists(paths[0])
+    while "updating_db" in client.cmd("status"):
+        time.sleep(0.01)
+    client.batch(("add", songs[0]))
+    try:
+        client.batch(("add", songs[1]))
+        raise AssertionError("An evicted song is still in mpd's database")
+    except CommandError:
+        pass
+
+
+async def test():
+    """Run SongQueue and the download eviction against a fake mpd."""
+    import logging
+    import tempfile
+
+    import trio
+
+    from fake_mpd import FakeMPD
+    logging.basicConfig(level=logging.DEBUG)
+    songs = ["_mpdbot/wwwyoutubecomwatchvfsbpwd-bac0.m4a",
+             "_mpdbot/epica-rivers-official-visualizer.mp3"]
+    with tempfile.TemporaryDirectory() as music_dir:
+        os.mkdir(os.path.join(music_dir, "_mpdbot"))
+        fake = FakeMPD({uri: 180.0 for uri in songs}, music_dir=music_dir)
+        async with trio.open_nursery() as nursery:
+            port = await nursery.start(fake.serve)
+            client = MPDClient("127.0.0.1", port)
+            await trio.to_thread.run_sync(_test_queue, client, songs)
+            await trio.to_thread.run_sync(_test_eviction, client, music_dir, songs)
+            nursery.cancel_scope.cancel()
+    print("SongQueue and eviction work")
 
 
 if __name__ == "__main__":
@@ -0,0 +1,99 @@
+################################################################################
+#      ____  ___    ____  ________     ____  ____  ______
+#     / __ \/   |  / __ \/  _/ __ \   / __ )/ __ \/_  __/
+#    / /_/ / /| | / / / // // / / /  / __  / / / / / /
+#   / _, _/ ___ |/ /_/ // // /_/ /  / /_/ / /_/ / / /
+#  /_/ |_/_/  |_/_____/___/\____/  /_____/\____/ /_/
+#
+#
+# Matheus Fillipe 18/05/2022
+# MIT License
+################################################################################
+
+
+import json
+import logging
+import os
+import subprocess
+import threading
+from dataclasses import dataclass, field
+from typing import Dict, Optional
+
+import mutagen
+from cachetools import LRUCache
+
+from metrics import registry
+
+PROBE_CACHE_SIZE = 1024
+FFPROBE_TIMEOUT = 30
+
+logger = logging.getLogger()
+probe_seconds = registry.histogram("mpdbot_probe_seconds", "Time to read the duration of an audio file")
+_cache = LRUCache(PROBE_CACHE_SIZE)
+_cache_lock = threading.Lock()
+
+
+class ProbeError(Exception):
+    pass
+
+
+@dataclass(frozen=True)
+class AudioInfo:
+    duration: float
+    tags: Dict[str, str] = field(default_factory=dict)
+
+
+def _mutagen_probe(path: str) -> Optional[AudioInfo]:
+    try:
+        audio = mutagen.File(path, easy=True)
+    except Exception as e:
+        logger.debug(f"mutagen could not read {path=}: {e}")
+        return None
+    if audio is None or not getattr(audio.info, "length", None):
+        return None
+    tags = {}
+    for key, value in (audio.tags or {}).items():
+        if isinstance(value, list):
+            value = value[0] if value else ""
+        tags[key.lower()] = str(value)
+    return AudioInfo(audio.info.length, tags)
+
+
+def _ffprobe(path: str) -> AudioInfo:
+    try:
+        output = subprocess.run(
+            ["ffprobe", "-v", "quiet", "-print_format", "json", "-show_format", "--", path],
+            capture_output=True, check=True, timeout=FFPROBE_TIMEOUT).stdout
+        fmt = json.loads(output)["format"]
+        return AudioInfo(
+            float(fmt["duration"]),
+            {k.lower(): str(v) for k, v in fmt.get("tags", {}).items()})
+    except (OSError, subprocess.SubprocessError, ValueError, KeyError) as e:
+        raise ProbeError(f"Could not probe {path}: {e}")
+
+
+def probe(path: str) -> AudioInfo:
+    """Duration and tags of an audio file.
+
+    Read in process with mutagen when the format is supported, falling back
+    to ffprobe otherwise. Results are cached until the file changes.
+    """
+    path = os.path.abspath(os.path.expanduser(path))
+    try:
+        stat = os.stat(path)
+    except OSError as e:
+        raise ProbeError(f"Could not probe {path}: {e}")
+    key = (path, stat.st_mtime_ns, stat.st_size)
+    with _cache_lock:
+        info = _cache.get(key)
+    if info is not None:
+        return info
+    with probe_seconds.time(backend="mutagen") as labels:
+        info = _mutagen_probe(path)
+        if info is None:
+            logger.debug(f"Falling back to ffprobe for {path=}")
+            labels["backend"] = "ffprobe"
+            info = _ffprobe(path)
+    with _cache_lock:
+        _cache[key] = info
+    return info
@@ -1,19 +1,63 @@
 # Mostly copied from: https://github.com/emlyn/sonic-pi-tool/, under MPL2 license
 
+import base64
 import collections
+import functools
 import html
+import itertools
 import logging
 import os
 import re
 import socket
 import sys
+import tempfile
+import threading
 import time
+import uuid
+from dataclasses import dataclass
+from typing import Awaitable, Callable, Dict, Iterable, List, Optional, Tuple
 
+import trio
+from cachetools import TTLCache
 from oscpy.client import OSCClient
+from oscpy.parser import format_message, read_packet
 from oscpy.server import OSCThreadServer
 
+from output import TokenBucket
+
 SERVER_OUTPUT = "~/.sonic-pi/log/server-output.log"
 
+# Bigger datagrams risk being dropped on the way or truncated by the receiver
+MAX_PACKET_SIZE = 8192
+# Where programs too big for a packet are written for a local sonic pi to
+# load, None to always send them in chunks
+STAGING_DIR = os.path.join(tempfile.gettempdir(), "mpdbot_sonic_pi")
+# Seconds a staged program is kept for sonic pi to read it
+STAGED_FILE_TTL = 600
+# Seconds between chunks, so sonic pi's receive buffer isn't overrun
+CHUNK_INTERVAL = 0.02
+# Seconds sonic pi waits for the missing chunks of a program
+CHUNK_TIMEOUT = 5
+LOCAL_HOSTS = {"127.0.0.1", "localhost", "::1"}
+
+# Where sonic pi sends its log, the port its GUI listens on
+LOG_ADDRESS = "127.0.0.1"
+LOG_PORT = 4558
+# Printed first by every submitted program so its run id can be learned
+MARKER = "[mpdbot run {}]"
+MARKER_RE = re.compile(r"\[mpdbot run (\d+)\]")
+# Lines the marker adds before the submitted code
+MARKER_LINES = 1
+# Logged by sonic pi once every thread of a run ended
+COMPLETED_RE = re.compile(r"Completed run (\d+)")
+# Seconds a submission waits for its run to show up in the log
+SUBMISSION_TIMEOUT = 30
+# Seconds a run is remembered after it was last heard of
+RUN_TTL = 3600
+# Errors per second and burst relayed to each user
+ERROR_RATE = 0.2
+ERROR_BURST = 3
+
 
 logger = logging.getLogger()
 
@@ -24,7 +68,23 @@ class Server:
     preamble = '@osc_server||=SonicPi::OSC::UDPServer.new' + \
                '({},use_decoder_cache:true) #__nosave__\n'
 
-    def __init__(self, host, cmd_port, osc_port, send_preamble, verbose):
+    # Chunks of a program are collected in a ruby global and run together by
+    # the last message once all of them arrived
+    chunks_init = '($mpdbot_chunks ||= {{}})["{id}"] = Array.new({count}) #__nosave__\n'
+    chunk_code = '$mpdbot_chunks["{id}"][{index}] = "{data}" #__nosave__\n'
+    chunks_run = (
+        '__chunks = $mpdbot_chunks["{id}"] #__nosave__\n'
+        '{polls}.times {{ break unless __chunks.include?(nil); Kernel.sleep 0.1 }} #__nosave__\n'
+        '$mpdbot_chunks.delete("{id}") #__nosave__\n'
+        'raise "Program {id} arrived incomplete" if __chunks.include?(nil) #__nosave__\n'
+        'run_code __chunks.join.unpack1("m").force_encoding("UTF-8") #__nosave__\n'
+    )
+
+    class SendError(Exception):
+        pass
+
+    def __init__(self, host, cmd_port, osc_port, send_preamble, verbose,
+                 staging_dir: Optional[str] = STAGING_DIR):
         self.client_name = 'SONIC_PI_TOOL_PY'
         self.host = host
         self._cmd_port = cmd_port
@@ -34,6 +94,12 @@ class Server:
         self.send_preamble = send_preamble
         self._cmd_client = None
         self._osc_client = None
+        self.staging_dir = staging_dir
+        self.max_packet_size = MAX_PACKET_SIZE
+        # The preamble is idempotent, it only needs to reach sonic pi once
+        self._preamble_sent = False
+        # Keeps the packets of a program from interleaving with another's
+        self._lock = threading.RLock()
 
     def get_cmd_port(self):
         return self._cmd_port
@@ -55,12 +121,27 @@ class Server:
             return Server.preamble.format(self.get_cmd_port())
         return ''
 
+    def message_size(self, msg, *args) -> int:
+        """Bytes of the datagram send_cmd would send."""
+        packet, _ = format_message(msg, (self.client_name,) + args, encoding='utf8')
+        return len(packet)
+
     def send_cmd(self, msg, *args):
+        """Send a command in a single datagram. Raises SendError if it is too
+        big or can't be sent."""
+        size = self.message_size(msg, *args)
+        if size > self.max_packet_size:
+            raise Server.SendError(f"{msg} is {size} bytes, over the {self.max_packet_size} bytes limit")
         client = self.cmd_client()
         logger.info("Sending command to {}:{}: {} {}"
                     .format(self.host, self.get_cmd_port(), msg,
                             ', '.join(repr(v) for v in (self.client_name,) + args)))
-        client.send_message(msg, (self.client_name,) + args)
+        try:
+            client.send_message(msg, (self.client_name,) + args)
+        except OSError as e:
+            # Sonic pi may have restarted without our state
+            self._preamble_sent = False
+            raise Server.SendError(f"Failed to reach sonic pi at {self.host}:{self.get_cmd_port()}: {e}")
 
     def send_osc(self, path, args):
         def parse_val(s):
@@ -106,8 +187,64 @@ class Server:
     def stop_all_jobs(self):
         self.send_cmd('/stop-all-jobs')
 
+    def is_local(self) -> bool:
+        return self.host in LOCAL_HOSTS
+
     def run_code(self, code):
-        self.send_cmd('/run-code', self.get_preamble() + code)
+        """Run a program of any size, blocking until it is sent. Raises
+        SendError."""
+        with self._lock:
+            if self.send_preamble and not self._preamble_sent:
+                self.send_cmd('/run-code', self.get_preamble())
+                self._preamble_sent = True
+            if self.message_size('/run-code', code) <= self.max_packet_size:
+                self.send_cmd('/run-code', code)
+            elif self.staging_dir and self.is_local():
+                self._run_staged(code)
+            else:
+                self._run_chunked(code)
+
+    def _run_staged(self, code):
+        """Write code to a file and have sonic pi load it."""
+        try:
+            os.makedirs(self.staging_dir, exist_ok=True)
+            self._clean_staging_dir()
+            fd, path = tempfile.mkstemp(suffix=".rb", dir=self.staging_dir)
+            with os.fdopen(fd, "w") as f:
+                f.write(code)
+            # Sonic pi may run as another user
+            os.chmod(path, 0o644)
+        except OSError as e:
+            raise Server.SendError(f"Failed to stage the program: {e}")
+        logger.info(f"Staged a program of {len(code)} characters at {path}")
+        self.send_cmd('/run-code', f'run_file "{path}" #__nosave__\n')
+
+    def _clean_staging_dir(self):
+        deadline = time.time() - STAGED_FILE_TTL
+        for entry in os.scandir(self.staging_dir):
+            try:
+                if entry.is_file() and entry.stat().st_mtime < deadline:
+                    os.remove(entry.path)
+            except OSError as e:
+                logger.warning(f"Failed to remove staged program {entry.path}: {e}")
+
+    def _run_chunked(self, code):
+        """Send code base64 encoded in as many packets as needed."""
+        data = base64.b64encode(code.encode()).decode()
+        run_id = uuid.uuid4().hex[:12]
+        overhead = self.message_size(
+            '/run-code', Server.chunk_code.format(id=run_id, index=len(data), data=""))
+        # OSC pads strings to a multiple of 4 bytes
+        chunk_size = self.max_packet_size - overhead - 4
+        chunks = [data[i:i + chunk_size] for i in range(0, len(data), chunk_size)]
+        logger.info(f"Sending a program of {len(code)} characters in {len(chunks)} chunks")
+        self.send_cmd('/run-code', Server.chunks_init.format(id=run_id, count=len(chunks)))
+        for index, chunk in enumerate(chunks):
+            time.sleep(CHUNK_INTERVAL)
+            self.send_cmd('/run-code', Server.chunk_code.format(id=run_id, index=index, data=chunk))
+        time.sleep(CHUNK_INTERVAL)
+        self.send_cmd('/run-code', Server.chunks_run.format(
+            id=run_id, polls=int(CHUNK_TIMEOUT / 0.1)))
 
     def start_recording(self):
         self.send_cmd('/start-recording')
@@ -138,9 +275,7 @@ class Server:
 
     @staticmethod
     def handle_log_info(style, msg):
-        msg = "=> {}".format(msg)
-        logger.info(msg)
-        logger.info()
+        logger.info("=> {}".format(msg))
 
     @staticmethod
     def handle_multi_message(run, thread, time, n, *msgs):
@@ -154,7 +289,6 @@ class Server:
                 else:
                     prefix = "  └─ " if j == 0 else "   "
                 logger.info(f"{prefix}, {line}, {typ}")
-        logger.info()
 
     @staticmethod
     def handle_runtime_error(run, msg, trace, line_num):
@@ -187,6 +321,143 @@ class Server:
             return e
 
 
+@dataclass
+class Submission:
+    nick: str
+    # Where errors are relayed to
+    target: str
+    submitted: float
+    # Its run completed or never started
+    finished: bool = False
+
+
+class LogListener:
+    """Follows the log sonic pi sends to its GUI and relays the errors of
+    each run to the user that submitted it.
+
+    Submitted code is tagged with a marker it prints first, tying sonic
+    pi's run id to the submission. Syntax errors stop a run before it
+    prints anything, so syntax errors of unknown runs are blamed on the
+    oldest submission still waiting for its run. Errors are rate limited per
+    user, the suppressed ones are counted in the next one relayed.
+    """
+
+    def __init__(self, port: int = LOG_PORT, address: str = LOG_ADDRESS):
+        self.port = port
+        self.address = address
+        self.pending: Dict[int, Submission] = collections.OrderedDict()
+        self.runs = TTLCache(1024, RUN_TTL)
+        self.buckets: Dict[str, TokenBucket] = TTLCache(1024, RUN_TTL)
+        self.suppressed: Dict[str, int] = collections.Counter()
+        self._ids = itertools.count(1)
+
+    def tag(self, nick: str, target: str, code: str) -> Tuple[str, Submission]:
+        """Code that reports its errors back to nick on target, and its
+        submission, which tells when the code finished running."""
+        now = time.monotonic()
+        for submission_id, submission in list(self.pending.items()):
+            if now - submission.submitted > SUBMISSION_TIMEOUT:
+                del self.pending[submission_id]
+        submission_id = next(self._ids)
+        submission = self.pending[submission_id] = Submission(nick, target, now)
+        return f'puts "{MARKER.format(submission_id)}" #__nosave__\n' + code, submission
+
+    def _submission(self, run) -> Optional[Submission]:
+        submission = self.runs.get(run)
+        while submission is None and self.pending:
+            _, submission = self.pending.popitem(last=False)
+            if time.monotonic() - submission.submitted > SUBMISSION_TIMEOUT:
+                submission = None
+        if submission is not None:
+            self.runs[run] = submission
+        return submission
+
+    @staticmethod
+    def _line(line_num) -> str:
+        """Where an error is in the submitted code, without the marker."""
+        line = int(line_num) - MARKER_LINES
+        return f" on line {line}" if line > 0 else ""
+
+    def handle(self, address: str, values: list) -> Optional[Tuple[Submission, str]]:
+        """Learn from a log message, returning the submission it is an error
+        of and the error."""
+        if address in ("/log/multi_message", "/multi_message") and len(values) >= 4:
+            run, texts = values[0], values[5::2]
+            for text in texts:
+                match = MARKER_RE.search(str(text))
+                submission = match and self.pending.pop(int(match[1]), None)
+                if submission:
+                    self.runs[run] = submission
+        elif address in ("/log/info", "/info") and len(values) >= 2:
+            match = COMPLETED_RE.search(str(values[1]))
+            submission = match and self.runs.get(int(match[1]))
+            if submission:
+                submission.finished = True
+        elif address == "/error" and len(values) >= 4:
+            run, msg, _, line_num = values[:4]
+            # Only runs that printed their marker can fail at runtime
+            submission = self.runs.get(run)
+            lines = html.unescape(msg).splitlines() or [""]
+            logger.debug(f"Sonic pi runtime error on {run=}: {lines[0]}")
+            if submission:
+                return submission, f"Runtime error{self._line(line_num)}: {lines[0]}"
+        elif address == "/syntax_error" and len(values) >= 4:
+            run, msg, _, line_num = values[:4]
+            submission = self._submission(run)
+            if submission:
+                submission.finished = True
+            msg = html.unescape(msg).splitlines()[0] if msg else ""
+            logger.debug(f"Sonic pi syntax error on {run=}: {msg}")
+            if submission:
+                return submission, f"Syntax error{self._line(line_num)}: {msg}"
+        return None
+
+    def allow(self, nick: str) -> bool:
+        """Whether an error can be relayed to nick now."""
+        now = time.monotonic()
+        bucket = self.buckets.get(nick)
+        if bucket is None:
+            bucket = self.buckets[nick] = TokenBucket(ERROR_RATE, ERROR_BURST, now)
+        if bucket.delay(now) > 0:
+            self.suppressed[nick] += 1
+            return False
+        bucket.take(now)
+        return True
+
+    async def run(self, handler: Callable[[str, str, str], Awaitable],
+                  task_status=trio.TASK_STATUS_IGNORED):
+        """Listen for the log, calling handler(target, nick, error) for each
+        error relayed."""
+        sock = trio.socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        try:
+            await sock.bind((self.address, self.port))
+        except OSError as e:
+            sock.close()
+            logger.error(f"Can't follow the sonic pi log on {self.address}:{self.port}: {e}")
+            task_status.started()
+            return
+        task_status.started()
+        with sock:
+            while True:
+                data = await sock.recv(65535)
+                try:
+                    messages = read_packet(data, encoding='utf8', encoding_errors='replace')
+                except Exception as e:
+                    logger.warning(f"Invalid packet in the sonic pi log: {e}")
+                    continue
+                for address, _, values, _ in messages:
+                    result = self.handle(address.decode(errors="replace"), values)
+                    if result is None:
+                        continue
+                    submission, text = result
+                    if not self.allow(submission.nick):
+                        continue
+                    suppressed = self.suppressed.pop(submission.nick, 0)
+                    if suppressed:
+                        text += f" ({suppressed} more suppressed)"
+                    await handler(submission.target, submission.nick, text)
+
+
 def eval_stdin(server: Server):
     server.run_code(sys.stdin.read())
 
@@ -242,32 +513,90 @@ notes_map_upper = collections.OrderedDict({
 
 
 class NoteNotFound(Exception):
-    pass
+    def __init__(self, *keys):
+        super().__init__(", ".join(keys))
+        self.keys = list(keys)
+
+
+def note_name(key: str, octave: int, transpose: int = 0) -> str:
+    """Sonic pi note of a keyboard key, computed from the key maps."""
+    if key in notes_map_upper:
+        pi_note = notes_map_upper[key]
+    elif key in notes_map_lower:
+        pi_note = notes_map_lower[key]
+    else:
+        raise NoteNotFound(key)
+    k_note = pi_note[:-1]
+    k_octave = int(pi_note[-1])
+    n_index = (NOTES.index(k_note) + transpose)
+    note = NOTES[n_index % len(NOTES)]
+    oct = k_octave + octave - 1 + n_index // len(NOTES)
+    return f":{note}{oct}"
+
+
+def _build_table(octave: int, transpose: int) -> dict:
+    return {key: note_name(key, octave, transpose)
+            for key in {**notes_map_lower, **notes_map_upper}}
+
+
+# key -> note for every (octave, transpose) pair commonly used, others are
+# built on demand
+TABLE_OCTAVES = range(0, 11)
+TABLE_TRANSPOSES = range(-12, 13)
+NOTE_TABLES = {(octave, transpose): _build_table(octave, transpose)
+               for octave in TABLE_OCTAVES for transpose in TABLE_TRANSPOSES}
+
+
+@functools.lru_cache(maxsize=256)
+def note_table(octave: int, transpose: int) -> dict:
+    """key -> note for an octave and transpose."""
+    table = NOTE_TABLES.get((octave, transpose))
+    return table if table is not None else _build_table(octave, transpose)
+
+
+def convert_many(specs: Iterable[Tuple[str, int, int]]) -> List[List[str]]:
+    """Notes of many (keys, octave, transpose) at once.
+
+    Raises NoteNotFound with every key that isn't a note.
+    """
+    results = []
+    unknown = {}
+    for kb_notes, octave, transpose in specs:
+        table = note_table(octave, transpose)
+        try:
+            results.append([table[key] for key in kb_notes])
+        except KeyError:
+            unknown.update(dict.fromkeys(key for key in kb_notes if key not in table))
+    if unknown:
+        raise NoteNotFound(*unknown)
+    return results
 
 
 def convert_to_notes(kb_notes: str, octave: int, transpose: int = 0) -> [str]:
-    notes = []
-    for key in kb_notes:
-        kmap = None
-        if key in notes_map_upper:
-            kmap = notes_map_upper
-        elif key in notes_map_lower:
-            kmap = notes_map_lower
-        else:
-            raise NoteNotFound(key)
-
-        pi_note = kmap[key]
-        k_note = pi_note[:-1]
-        k_octave = int(pi_note[-1])
-        n_index = (NOTES.index(k_note) + transpose)
-        note = NOTES[n_index % len(NOTES)]
-        oct = k_octave + octave - 1 + n_index // len(NOTES)
-        notes.append(f":{note}{oct}")
-
-    return notes
+    return convert_many([(kb_notes, octave, transpose)])[0]
+
+
+def benchmark(length: int = 64, rounds: int = 20000):
+    """Compare the table lookups with computing every note from the key
+    maps."""
+    keys = "".join(notes_map_lower) + "".join(notes_map_upper)
+    kb_notes = (keys * (length // len(keys) + 1))[:length]
+    specs = [(kb_notes, octave % 11, octave % 25 - 12) for octave in range(rounds)]
+    start = time.perf_counter()
+    for kb_notes, octave, transpose in specs:
+        [note_name(key, octave, transpose) for key in kb_notes]
+    computed = time.perf_counter() - start
+    start = time.perf_counter()
+    convert_many(specs)
+    tables = time.perf_counter() - start
+    print(f"{rounds} strings of {length} keys: computed {computed:.3f}s, "
+          f"tables {tables:.3f}s, {computed / tables:.1f}x faster")
 
 
 if __name__ == '__main__':
+    if sys.argv[1:] == ["--benchmark"]:
+        benchmark()
+        sys.exit()
     logging.basicConfig(level=logging.DEBUG)
     # server = Server(host, cmd_port, osc_port, preamble, verbose)
     server = Server("10.176.67.210", 4557, 4660, None, True)